@@ -1,13 +1,56 @@
-from flask import Flask, render_template, request, redirect, session, flash, url_for
+from flask import Flask, render_template, request, redirect, session, flash, url_for, g, Response, stream_with_context, jsonify, send_file
+import click
 import sqlite3
 import pickle
-import cv2
-import numpy as np
-from datetime import datetime
+import importlib
+from datetime import datetime, timedelta
 import os
 import base64
+import csv
+import io
+import json
 import uuid
+import secrets
+import shutil
+import struct
+import hashlib
+import tempfile
+import zipfile
+import sys
+import time
+import bisect
+import threading
+import atexit
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
 from functools import wraps
+from werkzeug.utils import secure_filename
+
+class LazyModule:
+    """Stand-in for a heavy module, imported on first attribute access.
+
+    OpenCV and numpy add a couple of hundred milliseconds to every import
+    of this file, and pages like the dashboard never touch them. The first
+    access imports the real module and rebinds the global name to it, so
+    later lookups go straight to the module.
+    """
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def _import(self):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return module
+
+    def __getattr__(self, attr):
+        # Only called for names the stand-in lacks, i.e. the module's own
+        return getattr(self._import(), attr)
+
+np = LazyModule("numpy", "np")
+cv2 = LazyModule("cv2", "cv2")
 
 app = Flask(__name__)
 app.secret_key = "supersecretkey123"
@@ -15,13 +58,86 @@ app.config['UPLOAD_FOLDER'] = 'static/uploads'
 
 DB_NAME = "attendance.db"
 
-# Define available modules
-MODULES = {
-    'ALDS301': 'Algorithm Design',
-    'SEP401': 'Software Engineering',
-    'DBS501': 'Database Systems',
-    'NWC601': 'Network Computing'
-}
+# SQLite connection pool (see ConnectionPool)
+app.config['DB_POOL_SIZE'] = 8                  # idle connections kept for reuse
+app.config['DB_BUSY_TIMEOUT'] = 5.0             # seconds to wait on a locked database
+app.config['DB_MMAP_SIZE'] = 256 * 1024 * 1024  # bytes of the file read via mmap
+
+# Approximate nearest-neighbour (IVF) index over the face templates.
+# ANN_NPROBE is the recall/latency knob: more lists probed = better recall.
+app.config['ANN_ENABLED'] = True
+app.config['ANN_INDEX_PATH'] = os.path.splitext(DB_NAME)[0] + ".ivf.npz"
+app.config['ANN_MIN_STUDENTS'] = 5000   # below this exact search is cheap enough
+app.config['ANN_NPROBE'] = 8
+
+# Memory-mapped template snapshots shared by every worker process: one
+# directory per template generation, written once and attached read-only
+# (see FaceTemplateCache)
+app.config['TEMPLATE_STORE_ENABLED'] = True
+app.config['TEMPLATE_STORE_DIR'] = os.path.splitext(DB_NAME)[0] + ".templates"
+app.config['TEMPLATE_STORE_KEEP'] = 2   # generations left on disk for workers still catching up
+app.config['TEMPLATE_STORE_WAIT'] = 2.0  # seconds a loading worker waits for a snapshot being written
+
+# Shared secret kiosks send in the X-Kiosk-Token header (None disables kiosk access)
+app.config['KIOSK_TOKEN'] = os.environ.get("KIOSK_TOKEN")
+app.config['CHECKIN_BATCH_LIMIT'] = 200
+app.config['CHECKIN_RETRY_AFTER'] = 5   # seconds a kiosk is told to wait when the job queue is busy
+
+# Live roll call from a camera feed (see StreamSession). The frame interval
+# adapts between the two bounds: fast while new faces appear, slow on a
+# static scene. STREAM_MAX_WORKERS caps frames analysed at once server-wide.
+app.config['STREAM_MIN_INTERVAL_MS'] = 250
+app.config['STREAM_MAX_INTERVAL_MS'] = 2000
+app.config['STREAM_HASH_DISTANCE'] = 4        # dHash bits; closer frames are skipped
+app.config['STREAM_MAX_WORKERS'] = 2
+app.config['STREAM_IDLE_TIMEOUT'] = 15 * 60   # seconds before an abandoned session expires
+
+# Worker pool for image processing behind the upload routes (see JobQueue)
+app.config['JOB_WORKERS'] = min(4, os.cpu_count() or 1)
+app.config['JOB_QUEUE_SIZE'] = 16      # jobs waiting beyond the busy workers before rejecting
+app.config['JOB_TIMEOUT'] = 10.0       # seconds a request waits before giving up or handing back a job id
+app.config['JOB_RESULT_TTL'] = 300     # seconds finished jobs stay pollable
+# Web bulk imports run one at a time on their own job thread, extracting
+# serially; bigger rosters belong to `flask bulk-import`, which uses every core
+app.config['BULK_WEB_MAX_ROWS'] = 1000
+
+# Dashboard aggregates cache (see AggregateCache)
+app.config['AGGREGATE_CACHE_TTL'] = 30       # seconds; bounds staleness from other processes
+app.config['AGGREGATE_CACHE_SIZE'] = 4096    # entries, least recently used evicted first
+
+# Opt-in sampling profiler: with PROFILING_ENABLED, a lecturer adds
+# ?profile=1 to any URL and reads the stacks back from /metrics/profiles
+app.config['PROFILING_ENABLED'] = os.environ.get("ATTENDANCE_PROFILING") == "1"
+app.config['PROFILING_INTERVAL'] = 0.005    # seconds between stack samples
+# Bearer token a Prometheus scraper sends to read /metrics without logging in
+# (None: lecturers only). A loopback check would let anything behind a local
+# reverse proxy through.
+app.config['METRICS_TOKEN'] = os.environ.get("METRICS_TOKEN")
+
+# Load OpenCV, the face detector and the template cache in the background
+# as soon as a worker starts, rather than on its first check-in (see create_app)
+app.config['VISION_WARM_UP'] = os.environ.get("ATTENDANCE_WARM_UP") == "1"
+
+# Storage precision for new face templates ("float16" or "float32")
+app.config['TEMPLATE_DTYPE'] = "float16"
+
+# Learned PCA (eigenfaces) projection applied to raw pixel features
+app.config['PROJECTION_PATH'] = os.path.splitext(DB_NAME)[0] + ".pca.npz"
+
+# Square thumbnails of student photos, served with long-lived cache headers
+# (see photo_thumbnail). Sizes are pixels per side, twice the CSS box so
+# they stay sharp on high-DPI screens.
+app.config['THUMBNAIL_DIR'] = os.path.splitext(DB_NAME)[0] + ".thumbnails"
+app.config['THUMBNAIL_SIZES'] = {"small": 120, "medium": 400}
+app.config['THUMBNAIL_MAX_AGE'] = 365 * 24 * 3600   # seconds; photo file names never get reused
+
+# Quality gate in front of face extraction (see assess_image_quality).
+# Brightness and sharpness are measured on a copy shrunk to 256 px.
+app.config['QUALITY_GATE_ENABLED'] = True
+app.config['QUALITY_MIN_SIDE'] = 120          # pixels, original resolution
+app.config['QUALITY_MIN_BRIGHTNESS'] = 40     # mean grey level, 0-255
+app.config['QUALITY_MAX_BRIGHTNESS'] = 225
+app.config['QUALITY_MIN_SHARPNESS'] = 25.0    # variance of the Laplacian
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -45,8 +161,654 @@ def student_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def kiosk_or_lecturer_required(f):
+    """JSON API access for a logged-in lecturer or a kiosk holding KIOSK_TOKEN"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = app.config['KIOSK_TOKEN']
+        supplied = request.headers.get("X-Kiosk-Token", "")
+        if "lecturer" not in session and not (token and secrets.compare_digest(supplied, token)):
+            return jsonify(error="Lecturer login or kiosk token required"), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+# ---------- FACE TEMPLATE FORMAT ----------
+# face_encoding BLOBs are a 12-byte header followed by the L2-normalised
+# vector as raw little-endian floats:
+#   magic "FTPL" | version u8 | dtype u8 | reserved u16 | dimension u32
+TEMPLATE_MAGIC = b"FTPL"
+TEMPLATE_VERSION = 1
+TEMPLATE_HEADER = struct.Struct("<4sBBHI")
+TEMPLATE_DTYPES = {1: "<f4", 2: "<f2"}
+TEMPLATE_DTYPE_CODES = {"float32": 1, "float16": 2}
+
+def encode_template(features, dtype=None):
+    """Serialise a feature vector into a versioned, pre-normalised template BLOB"""
+    code = TEMPLATE_DTYPE_CODES[dtype or app.config['TEMPLATE_DTYPE']]
+    vec = np.asarray(features, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vec)
+    if norm > 0:
+        vec = vec / norm
+    header = TEMPLATE_HEADER.pack(TEMPLATE_MAGIC, TEMPLATE_VERSION, code, 0, vec.shape[0])
+    return header + vec.astype(TEMPLATE_DTYPES[code]).tobytes()
+
+def is_template(blob):
+    return blob is not None and bytes(blob[:4]) == TEMPLATE_MAGIC
+
+def decode_template(blob):
+    """Read-only view of a template BLOB's vector (np.frombuffer, no copy), or None"""
+    if not is_template(blob) or len(blob) < TEMPLATE_HEADER.size:
+        return None
+    _, version, code, _, dim = TEMPLATE_HEADER.unpack_from(blob)
+    if version != TEMPLATE_VERSION or code not in TEMPLATE_DTYPES:
+        return None
+    dtype = np.dtype(TEMPLATE_DTYPES[code])
+    if len(blob) != TEMPLATE_HEADER.size + dim * dtype.itemsize:
+        return None
+    return np.frombuffer(blob, dtype=dtype, count=dim, offset=TEMPLATE_HEADER.size)
+
+def template_centroid(templates):
+    """Centroid of one student's enrolment templates and how spread out they are.
+
+    Returns (centroid, tightness, radius): the L2-normalised mean template,
+    the length of the un-normalised mean (1.0 when every template is the
+    same, smaller as they spread) and the largest angle in radians between
+    the centroid and any template. Matching uses the last two to bound a
+    probe's best per-template score from its centroid score alone.
+    """
+    vecs = np.atleast_2d(np.asarray(templates, dtype=np.float32))
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    vecs = vecs / np.where(norms == 0, 1, norms)
+    mean = vecs.mean(axis=0)
+    tightness = float(np.linalg.norm(mean))
+    if tightness == 0:
+        return vecs[0], 0.0, float(np.pi)
+    centroid = mean / tightness
+    radius = float(np.arccos(np.clip((vecs @ centroid).min(), -1.0, 1.0)))
+    return centroid, tightness, radius
+
+# (table, BLOB column) pairs holding templates
+TEMPLATE_COLUMNS = (("students", "face_encoding"), ("face_templates", "template"))
+
+def migrate_face_templates(conn, dtype=None, batch_size=500):
+    """Re-encode template BLOBs that are not in the current template format.
+
+    Converts legacy pickled float64 arrays (the only place pickle is still
+    loaded) and templates stored at a different precision, in both the
+    students centroids and the per-photo face_templates. Returns the number
+    of rows rewritten.
+    """
+    code = TEMPLATE_DTYPE_CODES[dtype or app.config['TEMPLATE_DTYPE']]
+    total = 0
+    for table, column in TEMPLATE_COLUMNS:
+        rows = conn.execute(f"SELECT id, {column} FROM {table} WHERE {column} IS NOT NULL").fetchall()
+
+        updates = []
+        for row_id, blob in rows:
+            if is_template(blob):
+                if TEMPLATE_HEADER.unpack_from(blob)[2] == code:
+                    continue
+                features = decode_template(blob)
+            else:
+                try:
+                    features = pickle.loads(blob)
+                except Exception as e:
+                    print(f"Skipping unreadable face template for {table} row {row_id}: {e}")
+                    continue
+            if features is None:
+                continue
+            updates.append((encode_template(features, dtype), row_id))
+
+        for start in range(0, len(updates), batch_size):
+            conn.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", updates[start:start + batch_size])
+        total += len(updates)
+    conn.commit()
+    return total
+
+def store_face_templates(conn, student_id, enrolments, replace=False):
+    """Insert (features, photo_path) enrolments into face_templates.
+
+    Returns (templates, removed_photo_paths): every template the student now
+    has, and with replace=True the photo files of the templates dropped
+    (for the caller to delete once the transaction commits). The caller
+    writes template_centroid(templates) to students.face_encoding in the
+    same transaction; that students write is what bumps the template
+    generation, so the face_templates table carries no triggers of its own.
+    """
+    removed = []
+    templates = []
+    if replace:
+        removed = [row[0] for row in conn.execute(
+            "SELECT photo_path FROM face_templates WHERE student_id = ? AND photo_path IS NOT NULL", (student_id,))]
+        conn.execute("DELETE FROM face_templates WHERE student_id = ?", (student_id,))
+    else:
+        for (blob,) in conn.execute("SELECT template FROM face_templates WHERE student_id = ? ORDER BY id",
+                                    (student_id,)):
+            vec = decode_template(blob)
+            if vec is not None:
+                templates.append(vec.astype(np.float32))
+
+    rows = []
+    for features, photo_path in enrolments:
+        blob = encode_template(features)
+        rows.append((student_id, blob, photo_path))
+        templates.append(decode_template(blob).astype(np.float32))
+    conn.executemany("INSERT INTO face_templates (student_id, template, photo_path) VALUES (?, ?, ?)", rows)
+    return templates, removed
+
+# ---------- METRICS ----------
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_READ_PREFIXES = ("SELECT", "WITH", "PRAGMA", "EXPLAIN")
+
+class Metrics:
+    """In-process latency histograms and counters, rendered in the Prometheus text format.
+
+    Each histogram is a dict of label tuples -> per-bucket counts plus sum;
+    observing is one bisect and a few additions under a lock. Values are
+    per process: scrape each worker separately.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}   # name -> {labels: [bucket counts, sum]}
+        self._counters = {}     # name -> {labels: count}
+        self._help = {}
+        self._local = threading.local()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, labels, seconds):
+        """Record one duration; labels is a tuple of (name, value) pairs"""
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(labels)
+            if counts is None:
+                counts = series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bucket] += 1
+            counts[1] += seconds
+
+    def increment(self, name, labels, amount=1):
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + amount
+
+    # --- Attribution of work to a route, per thread ---
+    @property
+    def route(self):
+        return getattr(self._local, "route", None) or "background"
+
+    def bind_route(self, route):
+        self._local.route = route
+
+    @contextmanager
+    def route_scope(self, route):
+        """Attribute SQL in this thread to route and report its db_read/db_write stage times.
+
+        Also usable as a function decorator.
+        """
+        previous = getattr(self._local, "route", None), getattr(self._local, "sql_time", None)
+        self._local.route, self._local.sql_time = route, {"read": 0.0, "write": 0.0}
+        try:
+            yield
+        finally:
+            for kind, seconds in self._local.sql_time.items():
+                if seconds:
+                    self.observe("attendance_stage_duration_seconds", (("route", route), ("stage", f"db_{kind}")), seconds)
+            self._local.route, self._local.sql_time = previous
+
+    @contextmanager
+    def stage(self, route, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("attendance_stage_duration_seconds", (("route", route), ("stage", stage)),
+                         time.perf_counter() - start)
+
+    def record_query(self, sql, seconds):
+        kind = "read" if sql.lstrip()[:7].upper().startswith(SQL_READ_PREFIXES) else "write"
+        self.observe("sqlite_query_duration_seconds", (("route", self.route), ("kind", kind)), seconds)
+        sql_time = getattr(self._local, "sql_time", None)
+        if sql_time is not None:
+            sql_time[kind] += seconds
+
+    # --- Exposition ---
+    @staticmethod
+    def _labels(pairs):
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}" if pairs else ""
+
+    def render(self, gauges=(), totals=()):
+        """Prometheus text exposition of every histogram and counter.
+
+        gauges and totals are extra (name, help, value) series kept elsewhere:
+        current levels, and running totals exported as counters.
+        """
+        lines = []
+        with self._lock:
+            snapshot = {name: {labels: (list(c[0]), c[1]) for labels, c in series.items()}
+                        for name, series in self._histograms.items()}
+            counters = {name: dict(series) for name, series in self._counters.items()}
+        for name in sorted(snapshot):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, (counts, total) in sorted(snapshot[name].items()):
+                running = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    running += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', le),))} {running}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{self._labels(labels)} {running}")
+        for name in sorted(counters):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, count in sorted(counters[name].items()):
+                lines.append(f"{name}{self._labels(labels)} {count}")
+        for kind, series in (("gauge", gauges), ("counter", totals)):
+            for name, help_text, value in series:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("http_request_duration_seconds", "Time to produce each response, by endpoint.")
+metrics.describe("attendance_stage_duration_seconds",
+                 "Check-in time per stage (decode, quality, extract, match, db_read, db_write).")
+metrics.describe("image_quality_rejections_total", "Images turned away by the quality gate, by reason.")
+metrics.describe("sqlite_query_duration_seconds", "SQLite statement execution time; _count is the number of statements.")
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that reports every statement and commit to `metrics`.
+
+    Only execute() itself is timed; for a SELECT that covers preparing and
+    stepping to the first row, not fetching the rest.
+    """
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.record_query(sql, time.perf_counter() - start)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            metrics.record_query("COMMIT", time.perf_counter() - start)
+
+class StackSampler:
+    """Sampling profiler: records the Python stacks of one thread, plus any
+    thread whose name starts with `name_prefix`, every `interval` seconds
+    from a background thread, as flame-graph-ready collapsed stacks
+    ("outer;inner;leaf count")."""
+
+    def __init__(self, thread_id, name_prefix=None, interval=0.005):
+        self.thread_id = thread_id
+        self.name_prefix = name_prefix
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            # Re-resolved every tick: job workers are started lazily
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != self.thread_id and not (
+                        self.name_prefix and names.get(thread_id, "").startswith(self.name_prefix)):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.stacks.items(), key=lambda s: -s[1]))
+
+profiles = deque(maxlen=20)   # (id, path, seconds, samples, collapsed stacks), newest last
+
+def profiling_requested():
+    return app.config['PROFILING_ENABLED'] and "lecturer" in session and request.args.get("profile") == "1"
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.bind_route(request.endpoint or "unmatched")
+    if profiling_requested():
+        # The request thread plus the job workers it may hand work to
+        g.profiler = StackSampler(threading.get_ident(), "job", app.config['PROFILING_INTERVAL']).start()
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.pop("request_started", time.perf_counter())
+    metrics.observe("http_request_duration_seconds",
+                    (("endpoint", request.endpoint or "unmatched"), ("method", request.method),
+                     ("status", str(response.status_code))), elapsed)
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+        profile_id = uuid.uuid4().hex[:12]
+        profiles.append((profile_id, request.full_path, elapsed, profiler.samples, profiler.collapsed()))
+        response.headers["X-Profile-Id"] = profile_id
+    return response
+
+@app.teardown_request
+def clear_request_metrics(exception):
+    metrics.bind_route(None)
+
 # ---------- DATABASE SETUP ----------
+# Schema migrations, applied in order on top of the base tables created in
+# init_db. PRAGMA user_version records how many have been applied.
+def _migration_attendance_indexes(conn):
+    """Unique (student, date, module) constraint plus indexes for the hot queries"""
+    # Drop duplicate check-ins so the unique index can be created
+    conn.execute("""
+        DELETE FROM attendance WHERE id NOT IN (
+            SELECT MIN(id) FROM attendance GROUP BY student_id, date, module_code
+        )
+    """)
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_attendance_student_date_module
+        ON attendance (student_id, date, module_code)
+    """)
+    # dashboard / view_attendance / view_report: WHERE date = ? [AND module_code = ?]
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_attendance_date
+        ON attendance (date, module_code, student_id, time)
+    """)
+    # student_dashboard: WHERE student_id = ? ORDER BY date DESC, time DESC
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_attendance_student
+        ON attendance (student_id, date, time, module_code)
+    """)
+
+def _migration_attendance_rollups(conn):
+    """Attendance summary tables kept current by triggers"""
+    # Students present per module per day
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS daily_module_attendance (
+            date TEXT NOT NULL,
+            module_code TEXT NOT NULL,
+            present_count INTEGER NOT NULL,
+            PRIMARY KEY (date, module_code)
+        )
+    """)
+    # Days each module has had at least one check-in
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS module_attendance_summary (
+            module_code TEXT PRIMARY KEY,
+            session_days INTEGER NOT NULL
+        )
+    """)
+    # Days each student was present per module
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS student_module_attendance (
+            student_id TEXT NOT NULL,
+            module_code TEXT NOT NULL,
+            days_present INTEGER NOT NULL,
+            PRIMARY KEY (student_id, module_code)
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS attendance_rollups_insert AFTER INSERT ON attendance
+        BEGIN
+            INSERT INTO module_attendance_summary (module_code, session_days)
+            SELECT NEW.module_code, 1
+            WHERE NOT EXISTS (SELECT 1 FROM daily_module_attendance
+                              WHERE date = NEW.date AND module_code = NEW.module_code)
+            ON CONFLICT (module_code) DO UPDATE SET session_days = session_days + 1;
+
+            INSERT INTO daily_module_attendance (date, module_code, present_count)
+            VALUES (NEW.date, NEW.module_code, 1)
+            ON CONFLICT (date, module_code) DO UPDATE SET present_count = present_count + 1;
+
+            INSERT INTO student_module_attendance (student_id, module_code, days_present)
+            VALUES (NEW.student_id, NEW.module_code, 1)
+            ON CONFLICT (student_id, module_code) DO UPDATE SET days_present = days_present + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS attendance_rollups_delete AFTER DELETE ON attendance
+        BEGIN
+            UPDATE daily_module_attendance SET present_count = present_count - 1
+            WHERE date = OLD.date AND module_code = OLD.module_code;
+            DELETE FROM daily_module_attendance
+            WHERE date = OLD.date AND module_code = OLD.module_code AND present_count <= 0;
+
+            UPDATE module_attendance_summary SET session_days = session_days - 1
+            WHERE module_code = OLD.module_code
+              AND NOT EXISTS (SELECT 1 FROM daily_module_attendance
+                              WHERE date = OLD.date AND module_code = OLD.module_code);
+
+            UPDATE student_module_attendance SET days_present = days_present - 1
+            WHERE student_id = OLD.student_id AND module_code = OLD.module_code;
+            DELETE FROM student_module_attendance
+            WHERE student_id = OLD.student_id AND module_code = OLD.module_code AND days_present <= 0;
+        END
+    """)
+    rebuild_attendance_rollups(conn)
+
+def rebuild_attendance_rollups(conn):
+    """Recompute every attendance summary table from the attendance rows"""
+    conn.execute("DELETE FROM daily_module_attendance")
+    conn.execute("DELETE FROM module_attendance_summary")
+    conn.execute("DELETE FROM student_module_attendance")
+    conn.execute("""
+        INSERT INTO daily_module_attendance (date, module_code, present_count)
+        SELECT date, module_code, COUNT(*) FROM attendance GROUP BY date, module_code
+    """)
+    conn.execute("""
+        INSERT INTO module_attendance_summary (module_code, session_days)
+        SELECT module_code, COUNT(*) FROM daily_module_attendance GROUP BY module_code
+    """)
+    conn.execute("""
+        INSERT INTO student_module_attendance (student_id, module_code, days_present)
+        SELECT student_id, module_code, COUNT(*) FROM attendance GROUP BY student_id, module_code
+    """)
+
+def _migration_student_list_indexes(conn):
+    """Indexes for the paginated, searchable student list"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_students_created ON students (created_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_students_name ON students (name COLLATE NOCASE)")
+
+def _migration_face_templates(conn):
+    """Several enrolment templates per student, with students.face_encoding as their centroid"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS face_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id TEXT NOT NULL,
+            template BLOB NOT NULL,
+            photo_path TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (student_id) REFERENCES students (student_id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_face_templates_student ON face_templates (student_id, id)")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS students_face_templates_delete AFTER DELETE ON students
+        BEGIN
+            DELETE FROM face_templates WHERE student_id = OLD.student_id;
+        END
+    """)
+    # The single existing template is its own centroid
+    conn.execute("""
+        INSERT INTO face_templates (student_id, template, photo_path)
+        SELECT student_id, face_encoding, photo_path FROM students
+        WHERE face_encoding IS NOT NULL
+    """)
+
+def _migration_module_rosters(conn):
+    """Modules and per-module enrolment rosters in the database"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS modules (
+            module_code TEXT PRIMARY KEY,
+            name TEXT NOT NULL
+        )
+    """)
+    # The modules that used to be hard-coded
+    conn.executemany("INSERT OR IGNORE INTO modules (module_code, name) VALUES (?, ?)", [
+        ('ALDS301', 'Algorithm Design'),
+        ('SEP401', 'Software Engineering'),
+        ('DBS501', 'Database Systems'),
+        ('NWC601', 'Network Computing'),
+    ])
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS enrolments (
+            module_code TEXT NOT NULL,
+            student_id TEXT NOT NULL,
+            enrolled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (module_code, student_id),
+            FOREIGN KEY (module_code) REFERENCES modules (module_code),
+            FOREIGN KEY (student_id) REFERENCES students (student_id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_enrolments_student ON enrolments (student_id, module_code)")
+    # Bumped on every roster change so the template cache knows when its
+    # per-module slices are stale (the same idea as template_generation)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS roster_generation (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO roster_generation (id, value) VALUES (1, 0)")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS enrolments_roster_insert AFTER INSERT ON enrolments
+        BEGIN
+            UPDATE roster_generation SET value = value + 1 WHERE id = 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS enrolments_roster_delete AFTER DELETE ON enrolments
+        BEGIN
+            UPDATE roster_generation SET value = value + 1 WHERE id = 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS students_enrolments_delete AFTER DELETE ON students
+        BEGIN
+            DELETE FROM enrolments WHERE student_id = OLD.student_id;
+        END
+    """)
+
+def _migration_template_store(conn):
+    """Random token naming this database's shared template snapshots"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS template_store (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            token TEXT NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO template_store (id, token) VALUES (1, lower(hex(randomblob(8))))")
+
+def _migration_student_id_search(conn):
+    """Case-insensitive index so student ID prefix searches are range scans"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_students_student_id_nocase ON students (student_id COLLATE NOCASE)")
+
+def _migration_job_results(conn):
+    """Outcomes of owned background jobs, so any worker can answer a poll"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_results (
+            job_id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            status TEXT NOT NULL,
+            result TEXT,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_job_results_updated ON job_results (updated_at)")
+
+def _migration_stream_sessions(conn):
+    """Live roll-call sessions and who they marked, shared by every worker"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stream_sessions (
+            id TEXT PRIMARY KEY,
+            lecturer TEXT NOT NULL,
+            module_code TEXT NOT NULL,
+            last_seen REAL NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            analysed INTEGER NOT NULL DEFAULT 0,
+            throttled INTEGER NOT NULL DEFAULT 0,
+            unchanged INTEGER NOT NULL DEFAULT 0,
+            poor_quality INTEGER NOT NULL DEFAULT 0,
+            busy INTEGER NOT NULL DEFAULT 0,
+            faces INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stream_marks (
+            stream_id TEXT NOT NULL,
+            student_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (stream_id, student_id)
+        )
+    """)
+
+SCHEMA_MIGRATIONS = [
+    _migration_attendance_indexes,
+    _migration_attendance_rollups,
+    _migration_student_list_indexes,
+    _migration_face_templates,
+    _migration_module_rosters,
+    _migration_template_store,
+    _migration_student_id_search,
+    _migration_job_results,
+    _migration_stream_sessions,
+]
+
+def migrate_schema(conn):
+    """Apply pending SCHEMA_MIGRATIONS, each in its own transaction"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migration in enumerate(SCHEMA_MIGRATIONS, start=1):
+        if version >= target:
+            continue
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied schema migration {target}: {migration.__doc__}")
+
 def init_db():
+    """Create the base tables and apply pending migrations (`flask init-db`).
+
+    Run once per deploy rather than on import, so starting a worker costs
+    no DDL; the connection pool refuses a database that is behind.
+    """
     conn = sqlite3.connect(DB_NAME)
     cur = conn.cursor()
     
@@ -85,6 +847,36 @@ def init_db():
         )
     """)
     
+    # Generation counter for the face template cache. Every change to a
+    # student's face template bumps it, so a cached copy of the templates
+    # can tell when the table changed underneath it (e.g. another process).
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS template_generation (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+    """)
+    cur.execute("INSERT OR IGNORE INTO template_generation (id, value) VALUES (1, 0)")
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS students_templates_insert AFTER INSERT ON students
+        BEGIN
+            UPDATE template_generation SET value = value + 1 WHERE id = 1;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS students_templates_update
+        AFTER UPDATE OF student_id, name, face_encoding ON students
+        BEGIN
+            UPDATE template_generation SET value = value + 1 WHERE id = 1;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS students_templates_delete AFTER DELETE ON students
+        BEGIN
+            UPDATE template_generation SET value = value + 1 WHERE id = 1;
+        END
+    """)
+    
     # Add default lecturer and a sample student
     cur.execute("INSERT OR IGNORE INTO lecturers VALUES (?, ?, ?)", 
                 ("admin", "1234", "Administrator"))
@@ -94,54 +886,1880 @@ def init_db():
                 ("S001", "Sample Student", "1234567890", "student123"))
     
     conn.commit()
+    
+    migrate_schema(conn)
+    
+    # One-shot upgrade of any legacy pickled face templates
+    migrate_face_templates(conn)
     conn.close()
 
-init_db()
+class ConnectionPool:
+    """Reusable SQLite connections, handed out one per app context.
+
+    Every connection runs in WAL mode so check-in writes don't block
+    readers, waits on a busy database instead of failing with "database is
+    locked", and keeps its prepared statements cached between requests.
+    """
+
+    def __init__(self, database, max_idle=8):
+        self.database = database
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=app.config['DB_BUSY_TIMEOUT'],
+                               check_same_thread=False, cached_statements=256, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA mmap_size = {int(app.config['DB_MMAP_SIZE'])}")
+        conn.execute("PRAGMA cache_size = -16000")   # 16 MB page cache
+        conn.execute("PRAGMA temp_store = MEMORY")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < len(SCHEMA_MIGRATIONS):
+            conn.close()
+            raise RuntimeError(f"{self.database} is at schema version {version}, this code needs "
+                               f"{len(SCHEMA_MIGRATIONS)}; run `flask init-db` first")
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+db_pool = ConnectionPool(DB_NAME, max_idle=app.config['DB_POOL_SIZE'])
+atexit.register(db_pool.close_all)   # checkpoint and release the idle connections on shutdown
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Pooled connection for the current app context, returned on teardown"""
+    if "db" not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    conn = g.pop("db", None)
+    if conn is not None:
+        db_pool.release(conn)
+
+# ---------- MODULES AND ENROLMENT ----------
+def get_modules(conn):
+    """{module_code: name} for every module, ordered by code"""
+    return {row['module_code']: row['name']
+            for row in conn.execute("SELECT module_code, name FROM modules ORDER BY module_code")}
+
+def get_roster_generation(conn):
+    return conn.execute("SELECT value FROM roster_generation WHERE id = 1").fetchone()[0]
+
+def may_attend(conn, student_id, module_code):
+    """True if student_id is on module_code's roster, or the module has no roster yet"""
+    has_roster, enrolled = conn.execute("""
+        SELECT EXISTS (SELECT 1 FROM enrolments WHERE module_code = ?),
+               EXISTS (SELECT 1 FROM enrolments WHERE module_code = ? AND student_id = ?)
+    """, (module_code, module_code, student_id)).fetchone()
+    return enrolled or not has_roster
+
+def parse_student_ids(text):
+    """Student IDs from free text (one per line, or comma / whitespace separated)"""
+    return list(dict.fromkeys(sid for sid in text.replace(",", " ").split()))
+
+def read_roster_ids(stream):
+    """Student IDs from the first column of a CSV, skipping a student_id header"""
+    ids = [row[0].strip() for row in csv.reader(stream) if row and row[0].strip()]
+    if ids and ids[0].lower() == "student_id":
+        ids = ids[1:]
+    return list(dict.fromkeys(ids))
+
+def registered_student_ids(conn, student_ids):
+    """The subset of student_ids that are registered students"""
+    known = set()
+    for start in range(0, len(student_ids), 500):   # stay well under SQLite's bound-parameter limit
+        chunk = student_ids[start:start + 500]
+        known.update(r[0] for r in conn.execute(
+            f"SELECT student_id FROM students WHERE student_id IN ({','.join('?' * len(chunk))})", chunk))
+    return known
+
+def enrol_students(conn, module_code, student_ids, replace=False):
+    """Put students on a module's roster; the caller commits.
+
+    With replace=True anyone not in student_ids is taken off the roster.
+    Returns (added, removed, unknown) where unknown lists IDs that are not
+    registered students.
+    """
+    student_ids = list(dict.fromkeys(student_ids))
+    known = registered_student_ids(conn, student_ids)
+    removed = 0
+    if replace:
+        current = {r[0] for r in conn.execute("SELECT student_id FROM enrolments WHERE module_code = ?", (module_code,))}
+        removed = conn.executemany("DELETE FROM enrolments WHERE module_code = ? AND student_id = ?",
+                                   [(module_code, sid) for sid in current - known]).rowcount
+    added = conn.executemany("INSERT OR IGNORE INTO enrolments (module_code, student_id) VALUES (?, ?)",
+                             [(module_code, sid) for sid in student_ids if sid in known]).rowcount
+    return added, removed, [sid for sid in student_ids if sid not in known]
 
 # ---------- SIMPLE FACE RECOGNITION (Alternative approach) ----------
-def extract_face_features(image_path):
-    """Extract simple facial features using OpenCV"""
+FACE_SIZE = (100, 100)
+DETECT_MAX_SIDE = 800   # frames are downscaled to this before running the detector
+DETECT_EQUALISE_BELOW = 80   # mean grey level under which frames are equalised for detection
+
+_face_detector = None
+
+def get_face_detector():
+    """Lazily load OpenCV's bundled frontal-face Haar cascade"""
+    global _face_detector
+    if _face_detector is None:
+        cascade_path = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
+        detector = cv2.CascadeClassifier(cascade_path)
+        _face_detector = detector if not detector.empty() else False
+    return _face_detector or None
+
+def detect_faces(gray):
+    """Return (x, y, w, h) boxes for every face found in a grayscale frame"""
+    detector = get_face_detector()
+    if detector is None:
+        return []
+
+    # Detect on a downscaled copy, then map the boxes back to full resolution.
+    # Dim frames are histogram-equalised first so the cascade still finds
+    # faces; only those, as the extra contrast makes detection several times
+    # slower on well-lit frames.
+    scale = min(1.0, DETECT_MAX_SIDE / max(gray.shape[:2]))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+    if small.mean() < DETECT_EQUALISE_BELOW:
+        small = cv2.equalizeHist(small)
+    min_side = max(24, int(min(small.shape[:2]) * 0.05))
+    faces = detector.detectMultiScale(small, scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side))
+    return [tuple(int(round(v / scale)) for v in face) for face in faces]
+
+def features_from_gray(gray):
+    """Turn a grayscale face crop into a flat, 0-1 scaled feature vector"""
+    gray = cv2.resize(gray, FACE_SIZE)
+    gray = gray / 255.0
+    return gray.flatten()
+
+def image_dimensions(data):
+    """Read (width, height) from a JPEG or PNG header without decoding, or None"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    # Walk the JPEG marker segments up to the start-of-frame header
+    pos = 2
+    while pos + 9 < len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[pos + 5:pos + 7], "big")
+            width = int.from_bytes(data[pos + 7:pos + 9], "big")
+            return width, height
+        pos += 2 + length
+    return None
+
+def decode_gray_image(data):
+    """Decode image bytes straight from memory into a grayscale array.
+
+    Large JPEGs are decoded at 1/2, 1/4 or 1/8 scale (libjpeg DCT scaling),
+    as long as the result stays at least DETECT_MAX_SIDE pixels on its long
+    side, so phone photos never get fully decoded just to be shrunk again.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    flag = cv2.IMREAD_GRAYSCALE
+    dims = image_dimensions(data)
+    if dims:
+        long_side = max(dims)
+        for factor, reduced in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                                (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                                (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if long_side // factor >= DETECT_MAX_SIDE:
+                flag = reduced
+                break
+    return cv2.imdecode(buf, flag)
+
+def load_gray_image(image):
+    """Grayscale array from in-memory image bytes, a file path or a decoded frame"""
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_gray_image(image)
+    img = cv2.imread(image)
+    if img is None:
+        return None
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+def extract_all_face_features(image, project=True, whole_frame_fallback=True):
+    """Extract one feature vector per face detected in a (classroom) photo.
+
+    Falls back to the whole frame when the detector finds no face, so a
+    tightly cropped single-face photo still produces a probe. Live video
+    turns the fallback off: an empty room must not match anyone.
+    """
+    try:
+        gray = load_gray_image(image)
+        if gray is None:
+            return []
+
+        faces = detect_faces(gray)
+        if not faces:
+            if not whole_frame_fallback:
+                return []
+            raw = [features_from_gray(gray)]
+        else:
+            raw = [features_from_gray(gray[y:y + h, x:x + w]) for x, y, w, h in faces]
+        return list(project_features(np.vstack(raw))) if project else raw
+    except Exception as e:
+        print(f"Error in feature extraction: {e}")
+        return []
+
+def extract_face_features(image, project=True):
+    """Extract simple facial features using OpenCV (largest face, or the whole image)"""
     try:
-        # Read image
-        img = cv2.imread(image_path)
-        if img is None:
+        gray = load_gray_image(image)
+        if gray is None:
             return None
-            
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # Resize to standard size
-        gray = cv2.resize(gray, (100, 100))
-        
-        # Normalize
-        gray = gray / 255.0
-        
-        # Flatten and return
-        return gray.flatten()
+
+        faces = detect_faces(gray)
+        if faces:
+            x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+            gray = gray[y:y + h, x:x + w]
+        features = features_from_gray(gray)
+        return project_features(features) if project else features
     except Exception as e:
         print(f"Error in feature extraction: {e}")
         return None
 
-def compare_faces(features1, features2, threshold=0.8):
-    """Compare two feature vectors using cosine similarity"""
-    if features1 is None or features2 is None:
-        return False
-        
-    # Simple cosine similarity
-    dot_product = np.dot(features1, features2)
-    norm1 = np.linalg.norm(features1)
-    norm2 = np.linalg.norm(features2)
-    
-    if norm1 == 0 or norm2 == 0:
+# ---------- IMAGE QUALITY GATE ----------
+QUALITY_ANALYSIS_SIDE = 256
+
+QualityReport = namedtuple("QualityReport", "reason message width height brightness sharpness")
+
+QUALITY_MESSAGES = {
+    "unreadable": "The image could not be read. Please try another photo.",
+    "too_small": "The photo is too small. Move closer to the camera or upload a larger image.",
+    "too_dark": "The photo is too dark. Find better lighting and try again.",
+    "too_bright": "The photo is overexposed. Avoid strong light behind or onto the face.",
+    "too_blurry": "The photo is blurry. Hold the camera still and try again.",
+}
+
+def quality_report(reason, width=None, height=None, brightness=None, sharpness=None):
+    return QualityReport(reason, QUALITY_MESSAGES.get(reason), width, height, brightness, sharpness)
+
+def image_too_small(image):
+    """QualityReport rejecting an undecoded upload from its header alone, or None"""
+    if not isinstance(image, (bytes, bytearray, memoryview)) or not app.config['QUALITY_GATE_ENABLED']:
+        return None
+    dims = image_dimensions(image)
+    if dims and min(dims) < app.config['QUALITY_MIN_SIDE']:
+        return quality_report("too_small", *dims)
+    return None
+
+def assess_image_quality(gray, size=None):
+    """Size, brightness and blur checks on a decoded grayscale frame.
+
+    size is the (width, height) before any reduced decode. Brightness is the
+    mean grey level and sharpness the variance of the Laplacian, both taken
+    on a copy shrunk to QUALITY_ANALYSIS_SIDE so the thresholds hold at any
+    resolution. The report's reason is None when the frame is usable.
+    """
+    if gray is None or gray.size == 0:
+        return quality_report("unreadable")
+    width, height = size or (gray.shape[1], gray.shape[0])
+    if not app.config['QUALITY_GATE_ENABLED']:
+        return quality_report(None, width, height)
+    if min(width, height) < app.config['QUALITY_MIN_SIDE']:
+        return quality_report("too_small", width, height)
+
+    scale = QUALITY_ANALYSIS_SIDE / max(gray.shape[:2])
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+    brightness = round(float(small.mean()), 1)
+    sharpness = round(float(cv2.Laplacian(small, cv2.CV_64F).var()), 1)
+    reason = None
+    if brightness < app.config['QUALITY_MIN_BRIGHTNESS']:
+        reason = "too_dark"
+    elif brightness > app.config['QUALITY_MAX_BRIGHTNESS']:
+        reason = "too_bright"
+    elif sharpness < app.config['QUALITY_MIN_SHARPNESS']:
+        reason = "too_blurry"
+    return quality_report(reason, width, height, brightness, sharpness)
+
+def gate_image(image, route):
+    """Decode an image only if it can pass the quality gate.
+
+    Returns (gray, report); gray is None when the image was rejected. The
+    header check costs microseconds, so undersized uploads are turned away
+    before any decoding. Empty or undecodable input is reported as
+    "unreadable". Decode and checks are timed as stages of route.
+    """
+    report = image_too_small(image)
+    gray = None
+    if report is None and isinstance(image, (bytes, bytearray, memoryview)) and not len(image):
+        report = quality_report("unreadable")
+    if report is None:
+        with metrics.stage(route, "decode"):
+            try:
+                gray = load_gray_image(image)
+            except Exception as e:
+                print(f"Could not decode image for {route}: {e}")
+        with metrics.stage(route, "quality"):
+            size = image_dimensions(image) if isinstance(image, (bytes, bytearray, memoryview)) else None
+            report = assess_image_quality(gray, size)
+    if report.reason:
+        metrics.increment("image_quality_rejections_total", (("route", route), ("reason", report.reason)))
+        return None, report
+    return gray, report
+
+def timed_extract(image, route, extractor=extract_face_features):
+    """Quality-gate an image, then run extractor on it, timing each stage for route.
+
+    Returns (features, QualityReport); features is None when the gate
+    turned the image away (see report.reason).
+    """
+    gray, report = gate_image(image, route)
+    if gray is None:
+        return None, report
+    with metrics.stage(route, "extract"):
+        return extractor(gray), report
+
+# ---------- PCA PROJECTION (eigenfaces) ----------
+class FaceProjection:
+    """Linear projection of L2-normalised raw pixel vectors onto their top
+    principal components. Fitted offline from the enrolled students with
+    `flask fit-projection` and stored next to the database.
+    """
+
+    def __init__(self, mean, components):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)   # (k, raw_dim)
+
+    @property
+    def dim(self):
+        return self.components.shape[0]
+
+    @property
+    def raw_dim(self):
+        return self.components.shape[1]
+
+    @staticmethod
+    def _prepare(raw):
+        raw = np.atleast_2d(np.asarray(raw, dtype=np.float32))
+        norms = np.linalg.norm(raw, axis=1, keepdims=True)
+        return raw / np.where(norms == 0, 1, norms)
+
+    @classmethod
+    def fit(cls, raw, n_components, sample_size=2000, seed=0):
+        data = cls._prepare(raw)
+        if len(data) > sample_size:
+            data = data[np.random.default_rng(seed).choice(len(data), sample_size, replace=False)]
+        mean = data.mean(axis=0)
+        centred = data - mean
+        n_components = min(n_components, len(data) - 1, data.shape[1])
+        if n_components < 2:
+            raise ValueError("need at least 3 enrolled faces to fit a projection")
+        # Economy SVD of the (samples x pixels) matrix; rows of vt are the eigenfaces
+        _, _, vt = np.linalg.svd(centred, full_matrices=False)
+        return cls(mean, vt[:n_components])
+
+    def apply(self, raw):
+        projected = (self._prepare(raw) - self.mean) @ self.components.T
+        return projected[0] if np.ndim(raw) == 1 else projected
+
+    def save(self, path):
+        # A private temporary name, so concurrent saves cannot clobber each other
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, mean=self.mean, components=self.components)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['mean'], data['components'])
+
+_projection_state = (None, None)   # (file mtime, FaceProjection)
+
+def get_projection():
+    """Current projection, reloaded whenever the file on disk changes"""
+    global _projection_state
+    path = app.config['PROJECTION_PATH']
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    if _projection_state[0] != mtime:
+        projection = None
+        if mtime is not None:
+            try:
+                projection = FaceProjection.load(path)
+            except Exception as e:
+                print(f"Ignoring unreadable projection {path}: {e}")
+        _projection_state = (mtime, projection)
+    return _projection_state[1]
+
+def project_features(raw):
+    """Apply the fitted projection to raw feature vector(s), if there is one"""
+    projection = get_projection()
+    if projection is None or np.shape(raw)[-1] != projection.raw_dim:
+        return raw
+    return projection.apply(raw)
+
+def decode_base64_image(value):
+    """Image bytes from base64 text, with or without a "data:image/...;base64," prefix"""
+    if value.startswith("data:"):
+        _, comma, value = value.partition(",")
+        if not comma:
+            raise ValueError("data: URL without a comma before the payload")
+    return base64.b64decode(value, validate=True)
+
+def read_submitted_image():
+    """Return (image_bytes, error) for the camera or upload field of this request.
+
+    The image stays in memory; nothing is written to the uploads folder, so
+    concurrent check-ins never see each other's photo.
+    """
+    if "camera_image" in request.form and request.form["camera_image"]:
+        try:
+            return decode_base64_image(request.form["camera_image"]), None
+        except Exception as e:
+            return None, f"Error decoding camera image: {e}"
+
+    if "photo" in request.files:
+        file = request.files["photo"]
+        if file.filename == "":
+            return None, "No selected file"
+        return file.read(), None
+
+    return None, "No photo or camera image provided"
+
+# ---------- FACE TEMPLATE CACHE ----------
+MATCH_THRESHOLD = 0.8
+MATCH_TOP_K = 5
+MATCH_SHORTLIST = 64    # most students re-ranked against their individual templates per probe
+
+Candidate = namedtuple("Candidate", "student_id name score")
+MatchResult = namedtuple("MatchResult", "candidates margin")
+
+def best_match(result, threshold=MATCH_THRESHOLD):
+    """Return the top Candidate of a MatchResult if it clears the threshold"""
+    if result.candidates and result.candidates[0].score > threshold:
+        return result.candidates[0]
+    return None
+
+def get_template_generation(conn):
+    return conn.execute("SELECT value FROM template_generation WHERE id = 1").fetchone()[0]
+
+class IVFIndex:
+    """Inverted-file index over L2-normalised templates (spherical k-means).
+
+    Every template belongs to the list of its nearest centroid; a query only
+    scores the templates in its nprobe nearest lists. Trained offline with
+    `flask build-ann-index` and saved next to the database. Only the
+    centroids are persisted: list membership is assigned when the template
+    cache loads and kept current in memory as students change.
+    """
+
+    def __init__(self, centroids):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.fingerprint = hashlib.sha1(self.centroids.tobytes()).hexdigest()[:16]
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @property
+    def dim(self):
+        return self.centroids.shape[1]
+
+    @classmethod
+    def train(cls, matrix, nlist, iterations=10, sample_size=20000, seed=0):
+        rng = np.random.default_rng(seed)
+        data = matrix
+        if len(data) > sample_size:
+            data = data[rng.choice(len(data), sample_size, replace=False)]
+        nlist = max(1, min(nlist, len(data)))
+        centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignment = cls(centroids).assign(data)
+            order = np.argsort(assignment, kind="stable")
+            counts = np.bincount(assignment, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            present = np.flatnonzero(counts)
+            starts = np.concatenate(([0], np.cumsum(counts[present])[:-1]))
+            sums[present] = np.add.reduceat(data[order], starts, axis=0)
+            # Re-seed empty lists from random templates
+            empty = np.flatnonzero(counts == 0)
+            sums[empty] = data[rng.choice(len(data), len(empty))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.where(norms == 0, 1, norms)
+
+        return cls(centroids)
+
+    def assign(self, vectors, chunk=4096):
+        """Index of the nearest centroid for each row of vectors"""
+        vectors = np.atleast_2d(vectors)
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk):
+            out[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ self.centroids.T, axis=1)
+        return out
+
+    def nearest_lists(self, probes, nprobe):
+        scores = probes @ self.centroids.T
+        nprobe = min(nprobe, self.nlist)
+        if nprobe == self.nlist:
+            return np.broadcast_to(np.arange(self.nlist), (len(probes), nprobe))
+        return np.argpartition(-scores, nprobe - 1, axis=1)[:, :nprobe]
+
+    def save(self, path):
+        # A private temporary name, so concurrent saves cannot clobber each other
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centroids=self.centroids)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Return the saved index, or None if there is no usable file"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                return cls(data['centroids'])
+        except Exception as e:
+            print(f"Ignoring unreadable ANN index {path}: {e}")
+            return None
+
+def template_store_path(conn, generation):
+    """Snapshot directory for a template generation, or None when the store is off.
+
+    Names carry the database's random token, so a recreated database never
+    attaches snapshots left behind by the old one.
+    """
+    if not app.config['TEMPLATE_STORE_ENABLED']:
+        return None
+    token = conn.execute("SELECT token FROM template_store WHERE id = 1").fetchone()[0]
+    return os.path.join(app.config['TEMPLATE_STORE_DIR'], f"{token}-{generation}")
+
+def prune_template_store(path, keep):
+    """Remove all but the `keep` newest snapshots next to path (plus foreign and abandoned ones).
+
+    Workers that still map a removed snapshot keep reading it; the space is
+    freed when the last one lets go.
+    """
+    store, name = os.path.split(path)
+    token = name.rsplit("-", 1)[0]
+    ours, stale = [], []
+    for entry in os.scandir(store):
+        base, _, suffix = entry.name.partition(".tmp-")
+        entry_token, _, generation = base.rpartition("-")
+        if suffix:
+            if entry.stat().st_mtime < time.time() - 3600:
+                stale.append(entry.path)   # a writer died mid-snapshot
+        elif entry_token == token and generation.isdigit():
+            ours.append((int(generation), entry.path))
+        else:
+            stale.append(entry.path)
+    stale += [p for _, p in sorted(ours, reverse=True)[keep:]]
+    for p in stale:
+        shutil.rmtree(p, ignore_errors=True)
+
+def snapshot_in_progress(path):
+    """True if some process started writing the snapshot for path in the last minute"""
+    store, name = os.path.split(path)
+    try:
+        return any(entry.name.startswith(f"{name}.tmp-") and entry.stat().st_mtime > time.time() - 60
+                   for entry in os.scandir(store))
+    except OSError:
         return False
-        
-    similarity = dot_product / (norm1 * norm2)
-    return similarity > threshold
+
+# What a snapshot is written from: references to arrays and lists the cache
+# has stopped modifying, so the writer needs no lock
+TemplateSnapshot = namedtuple("TemplateSnapshot", "centroids tightness radius student_ids names templates ann_fingerprint lists")
+
+class FaceTemplateCache:
+    """Process-wide cache of every enrolled student's face templates.
+
+    Each student's centroid template is kept L2-normalised in one contiguous
+    float32 matrix with parallel student id / name lists, so scoring a probe
+    against everyone is a single matrix-vector product. Alongside it the
+    cache holds every individual enrolment template plus two spread figures
+    per student (see template_centroid), which matching uses to re-rank a
+    short list without scoring every template. The cache remembers the
+    template generation it was built from and reloads itself when the
+    database has moved on without it.
+
+    Per-module slices (the rows and centroids of the students on a
+    module's roster) are built on first use and kept until the roster
+    generation or the cache itself changes.
+
+    With TEMPLATE_STORE_ENABLED every generation is also published as a
+    snapshot directory of .npy files, which other worker processes map
+    read-only instead of decoding the database themselves: the page cache
+    holds one copy however many workers there are, and a new worker starts
+    warm. The process that makes a change copies the arrays and applies
+    it; a background thread then writes the next generation's snapshot
+    and maps it in turn, so neither the request nor match() waits for the
+    write. Only the newest pending generation is written.
+
+    Arrays and lists are never modified once other threads can see them:
+    match() keeps using what it picked up under the lock after letting go
+    of it, so every change works on fresh copies and swaps them in.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buffer = None      # (capacity, dim) float32 centroids, rows [0, size) are live
+        self._tightness = None   # parallel to _buffer, see template_centroid
+        self._radius = None      # parallel to _buffer, see template_centroid
+        self.size = 0
+        self.student_ids = []
+        self.names = []
+        self.templates = {}      # student_id -> (n, dim) float32 enrolment templates
+        self._row_of = {}        # student_id -> row index
+        self.generation = None   # None means "reload before next use"
+        self.ann = None          # IVFIndex, when one has been built
+        self._lists = None       # IVF list of each row, parallel to _buffer
+        self._inverted = None    # (rows, bounds) grouping live rows by IVF list, built lazily
+        self._slices = {}        # module_code -> (rows, centroids), or None when it has no roster
+        self.roster_generation = None
+        self.shared = False      # arrays are read-only maps of a snapshot
+        self._publish_cond = threading.Condition()
+        self._publish_next = None   # (path, generation, TemplateSnapshot) for the publisher thread
+        self._publishing = False
+
+    @property
+    def matrix(self):
+        if self._buffer is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._buffer[:self.size]
+
+    def invalidate(self):
+        with self._lock:
+            self.generation = None
+
+    def load(self, conn, from_store=True):
+        """Rebuild the whole cache for the current template generation.
+
+        Maps that generation's shared snapshot when one has been published;
+        otherwise reads the students and face_templates tables and publishes
+        a snapshot for the other workers.
+        """
+        with self._lock:
+            generation = get_template_generation(conn)
+            path = template_store_path(conn, generation)
+            if path and from_store and not os.path.isdir(path) and snapshot_in_progress(path):
+                # Another worker is writing it: mapping beats decoding the database
+                deadline = time.monotonic() + app.config['TEMPLATE_STORE_WAIT']
+                while not os.path.isdir(path) and time.monotonic() < deadline:
+                    time.sleep(0.02)
+            if path and from_store and os.path.isdir(path) and self._attach_snapshot(path, generation):
+                return
+
+            count = conn.execute("SELECT COUNT(*) FROM students WHERE face_encoding IS NOT NULL").fetchone()[0]
+            rows = conn.execute("""
+                SELECT student_id, name, face_encoding FROM students
+                WHERE face_encoding IS NOT NULL
+                ORDER BY id
+            """)
+
+            # Templates are stored normalised, so each one is copied straight
+            # from its BLOB into a preallocated row of the matrix.
+            buffer, student_ids, names = None, [], []
+            for row in rows:
+                vec = decode_template(row['face_encoding'])
+                if vec is None or (buffer is not None and vec.shape[0] != buffer.shape[1]):
+                    print(f"Skipping unusable face template for {row['student_id']}")
+                    continue
+                if buffer is None:
+                    buffer = np.empty((max(count, 1), vec.shape[0]), dtype=np.float32)
+                if len(student_ids) == buffer.shape[0]:
+                    break   # rows were added while we were reading; next load picks them up
+                buffer[len(student_ids)] = vec
+                student_ids.append(row['student_id'])
+                names.append(row['name'])
+
+            # Individual templates; a student without any counts as one
+            # template equal to the centroid
+            row_of = {sid: i for i, sid in enumerate(student_ids)}
+            grouped = {}
+            if buffer is not None:
+                for row in conn.execute("SELECT student_id, template FROM face_templates ORDER BY id"):
+                    vec = decode_template(row['template'])
+                    if row['student_id'] in row_of and vec is not None and vec.shape[0] == buffer.shape[1]:
+                        grouped.setdefault(row['student_id'], []).append(vec)
+
+            capacity = buffer.shape[0] if buffer is not None else 0
+            tightness = np.ones(capacity, dtype=np.float32)
+            radius = np.zeros(capacity, dtype=np.float32)
+            templates = {}
+            for sid, vecs in grouped.items():
+                templates[sid] = np.vstack(vecs).astype(np.float32)
+                _, tightness[row_of[sid]], radius[row_of[sid]] = template_centroid(templates[sid])
+
+            self._buffer = buffer
+            self._tightness = tightness
+            self._radius = radius
+            self.size = len(student_ids)
+            self.student_ids = student_ids
+            self.names = names
+            self.templates = templates
+            self._row_of = row_of
+            self._slices = {}
+            self.shared = False
+            self.generation = generation
+            self._attach_ann()
+            if path and not os.path.isdir(path):
+                self._publish(path, generation)
+
+    def _attach_snapshot(self, path, generation):
+        """Map a published snapshot read-only; False if it cannot be read"""
+        try:
+            # Plain ndarray views of the maps: np.memmap's per-slice
+            # bookkeeping is slow over 100k students
+            mapped = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r").view(np.ndarray)
+                      for name in ("centroids", "tightness", "radius", "templates")}
+            offsets = np.load(os.path.join(path, "offsets.npy")).tolist()
+            student_ids = np.load(os.path.join(path, "student_ids.npy")).tolist()
+            names = np.load(os.path.join(path, "names.npy")).tolist()
+            ann_lists = None
+            if os.path.exists(os.path.join(path, "ann_lists.npy")):
+                ann_lists = (str(np.load(os.path.join(path, "ann_fingerprint.npy"))),
+                             np.load(os.path.join(path, "ann_lists.npy")))
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable template snapshot {path}: {e}")
+            return False
+
+        stacked = mapped["templates"]
+        self._buffer = mapped["centroids"]
+        self._tightness = mapped["tightness"]
+        self._radius = mapped["radius"]
+        self.size = len(student_ids)
+        self.student_ids = student_ids
+        self.names = names
+        self.templates = {sid: stacked[offsets[i]:offsets[i + 1]]
+                          for i, sid in enumerate(student_ids) if offsets[i + 1] > offsets[i]}
+        self._row_of = {sid: i for i, sid in enumerate(student_ids)}
+        self._slices = {}
+        self.shared = True
+        self.generation = generation
+        self._attach_ann(snapshot_lists=ann_lists)
+        return True
+
+    def _write_snapshot(self, path, state):
+        """Write a TemplateSnapshot to directory path, published by one atomic rename.
+
+        Returns False if that failed, including when another process
+        published the same generation first.
+        """
+        tmp = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+        try:
+            os.makedirs(tmp)
+            blocks = [state.templates.get(sid) for sid in state.student_ids]
+            offsets = np.zeros(len(blocks) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([0 if b is None else len(b) for b in blocks])
+            np.save(os.path.join(tmp, "centroids.npy"), state.centroids)
+            np.save(os.path.join(tmp, "tightness.npy"), state.tightness)
+            np.save(os.path.join(tmp, "radius.npy"), state.radius)
+            np.save(os.path.join(tmp, "student_ids.npy"), np.array(state.student_ids, dtype=str))
+            np.save(os.path.join(tmp, "names.npy"), np.array(state.names, dtype=str))
+            np.save(os.path.join(tmp, "offsets.npy"), offsets)
+            if state.lists is not None:
+                np.save(os.path.join(tmp, "ann_fingerprint.npy"), np.array(state.ann_fingerprint))
+                np.save(os.path.join(tmp, "ann_lists.npy"), state.lists)
+            # Templates are concatenated straight into the file
+            shape = (int(offsets[-1]), state.centroids.shape[1])
+            if shape[0]:
+                out = np.lib.format.open_memmap(os.path.join(tmp, "templates.npy"), mode="w+",
+                                                dtype=np.float32, shape=shape)
+                np.concatenate([b for b in blocks if b is not None], out=out.view(np.ndarray))
+                out.flush()
+                del out
+            else:
+                np.save(os.path.join(tmp, "templates.npy"), np.empty(shape, dtype=np.float32))
+            os.rename(tmp, path)
+            return True
+        except OSError as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(path):
+                print(f"Could not publish template snapshot {path}: {e}")
+            return False
+
+    def _publish(self, path, generation):
+        """Queue the current rows to be shared as generation's snapshot (caller holds the lock)"""
+        if not self.size:
+            return
+        state = TemplateSnapshot(self._buffer[:self.size], self._tightness[:self.size], self._radius[:self.size],
+                                 self.student_ids, self.names, self.templates,
+                                 self.ann.fingerprint if self.ann is not None else None,
+                                 self._lists[:self.size] if self.ann is not None else None)
+        with self._publish_cond:
+            self._publish_next = (path, generation, state)
+            if not self._publishing:
+                self._publishing = True
+                threading.Thread(target=self._publisher, name="template-publisher", daemon=True).start()
+
+    def _publisher(self):
+        """Write queued snapshots, skipping superseded ones, and map each once written"""
+        while True:
+            with self._publish_cond:
+                pending, self._publish_next = self._publish_next, None
+                if pending is None:
+                    self._publishing = False
+                    self._publish_cond.notify_all()
+                    return
+            path, generation, state = pending
+            if self._write_snapshot(path, state):
+                try:
+                    prune_template_store(path, app.config['TEMPLATE_STORE_KEEP'])
+                except OSError as e:
+                    print(f"Could not prune template snapshots: {e}")
+            # Mapping it (ours or a concurrent writer's) drops our private
+            # copy, unless the cache has moved on in the meantime
+            if os.path.isdir(path):
+                with self._lock:
+                    if self.generation == generation and not self.shared:
+                        self._attach_snapshot(path, generation)
+
+    def flush(self, timeout=None):
+        """Wait until queued snapshots are written; False on timeout"""
+        with self._publish_cond:
+            return self._publish_cond.wait_for(lambda: not self._publishing, timeout)
+
+    def _attach_ann(self, index=None, snapshot_lists=None):
+        """Hook the persisted IVF index up to the freshly loaded rows.
+
+        Each row's list comes from the snapshot when it was published
+        against this same index (snapshot_lists is (fingerprint, lists));
+        otherwise every row is assigned afresh.
+        """
+        self.ann, self._lists, self._inverted = None, None, None
+        if index is None:
+            if not app.config['ANN_ENABLED']:
+                return
+            index = IVFIndex.load(app.config['ANN_INDEX_PATH'])
+        if index is None or self._buffer is None or index.dim != self._buffer.shape[1]:
+            return
+
+        self._lists = np.full(self._buffer.shape[0], -1, dtype=np.int32)
+        if snapshot_lists is not None and snapshot_lists[0] == index.fingerprint:
+            self._lists[:self.size] = snapshot_lists[1]
+        elif self.size:
+            self._lists[:self.size] = index.assign(self._buffer[:self.size])
+        self.ann = index
+
+    def build_ann(self, conn, nlist=None):
+        """Train a new IVF index on the current templates and persist it"""
+        self.ensure_fresh(conn)
+        with self._lock:
+            if self.size == 0:
+                return None
+            nlist = nlist or max(1, int(round(4 * np.sqrt(self.size))))
+            index = IVFIndex.train(self.matrix, nlist)
+            index.save(app.config['ANN_INDEX_PATH'])
+            self._attach_ann(index)
+            return index
+
+    def ensure_fresh(self, conn):
+        if self.generation is None or self.generation != get_template_generation(conn):
+            self.load(conn)
+
+    def _apply(self, conn, change):
+        """Apply an in-place change that the caller has just committed.
+
+        Exactly one generation step means ours was the only write since the
+        cache was built; anything else means someone else wrote too, so the
+        cache is dropped and reloaded on next use instead. The result is
+        queued to be published as the new generation's snapshot, so the
+        other workers pick it up without touching the database.
+        """
+        with self._lock:
+            generation = get_template_generation(conn)
+            if self.generation is None or generation != self.generation + 1:
+                self.generation = None
+                return
+            # Copy-on-write: a match() running outside the lock may still be
+            # scoring the current arrays, and mapped snapshots are read-only
+            if self._buffer is not None:
+                self._buffer = np.array(self._buffer)
+                self._tightness = np.array(self._tightness)
+                self._radius = np.array(self._radius)
+            if self._lists is not None:
+                self._lists = self._lists.copy()
+            self.student_ids = list(self.student_ids)
+            self.names = list(self.names)
+            self.templates = dict(self.templates)
+            self._row_of = dict(self._row_of)
+            self.shared = False
+            change()
+            self._slices = {}
+            self._inverted = None
+            self.generation = generation
+            path = template_store_path(conn, generation)
+            if path:
+                self._publish(path, generation)
+
+    def upsert(self, conn, student_id, name, templates=None):
+        """Add or update one student after register_student / edit_student.
+
+        templates is every enrolment template the student now has (as
+        returned by store_face_templates), or None when only the name changed.
+        """
+        def change():
+            row = self._row_of.get(student_id)
+            spread = None
+            if templates is not None and len(templates):
+                stacked = np.vstack([np.asarray(t, dtype=np.float32).ravel() for t in templates])
+                norms = np.linalg.norm(stacked, axis=1, keepdims=True)
+                stacked /= np.where(norms == 0, 1, norms)
+                centroid, tightness, radius = template_centroid(stacked)
+                spread = (stacked, centroid, tightness, radius)
+            if row is None:
+                if spread is None:
+                    return
+                dim = spread[1].shape[0]
+                if self._buffer is None:
+                    self._buffer = np.empty((16, dim), dtype=np.float32)
+                    self._tightness = np.ones(16, dtype=np.float32)
+                    self._radius = np.zeros(16, dtype=np.float32)
+                elif dim != self._buffer.shape[1]:
+                    raise ValueError("face template dimension mismatch")
+                elif self.size == self._buffer.shape[0]:
+                    grown = np.empty((self.size * 2, self._buffer.shape[1]), dtype=np.float32)
+                    grown[:self.size] = self._buffer[:self.size]
+                    self._buffer = grown
+                    self._tightness = np.concatenate((self._tightness, np.ones(self.size, dtype=np.float32)))
+                    self._radius = np.concatenate((self._radius, np.zeros(self.size, dtype=np.float32)))
+                    if self.ann is not None:
+                        self._lists = np.concatenate((self._lists, np.full(self.size, -1, dtype=np.int32)))
+                row = self.size
+                self.size += 1
+                self.student_ids.append(student_id)
+                self.names.append(name)
+                self._row_of[student_id] = row
+            else:
+                self.names[row] = name
+            if spread is not None:
+                stacked, centroid, tightness, radius = spread
+                if centroid.shape[0] != self._buffer.shape[1]:
+                    raise ValueError("face template dimension mismatch")
+                self._buffer[row] = centroid
+                self._tightness[row] = tightness
+                self._radius[row] = radius
+                self.templates[student_id] = stacked
+                if self.ann is not None:
+                    self._lists[row] = self.ann.assign(centroid)[0]
+
+        try:
+            self._apply(conn, change)
+        except ValueError:
+            self.invalidate()
+
+    def remove(self, conn, student_id):
+        """Drop one student after delete_student (swap-with-last removal)"""
+        def change():
+            row = self._row_of.pop(student_id, None)
+            self.templates.pop(student_id, None)
+            if row is None:
+                return
+            last = self.size - 1
+            if row != last:
+                self._buffer[row] = self._buffer[last]
+                self._tightness[row] = self._tightness[last]
+                self._radius[row] = self._radius[last]
+                self.student_ids[row] = self.student_ids[last]
+                self.names[row] = self.names[last]
+                self._row_of[self.student_ids[row]] = row
+                if self.ann is not None:
+                    self._lists[row] = self._lists[last]
+            self.student_ids.pop()
+            self.names.pop()
+            self.size = last
+
+        self._apply(conn, change)
+
+    @staticmethod
+    def _shortlist(scores, tightness, radius, k, limit=MATCH_SHORTLIST):
+        """Positions in scores whose best individual template could make the top k.
+
+        A student's best template score is at least tightness * centroid
+        score (it beats the mean) and at most cos(angle to centroid - radius).
+        Anyone whose upper bound falls below the k-th best lower bound cannot
+        make the top k and is never re-scored. The 1e-3 slack absorbs
+        float16 rounding of stored templates. Past `limit` survivors the
+        best centroid scores are kept.
+        """
+        k = min(k, scores.size)
+        lower = tightness * scores
+        floor = np.partition(lower, scores.size - k)[scores.size - k]
+        upper = np.cos(np.maximum(np.arccos(np.clip(scores, -1.0, 1.0)) - radius, 0.0))
+        short = np.flatnonzero(upper >= floor - 1e-3)
+        if short.size > limit:
+            short = short[np.argpartition(-scores[short], limit - 1)[:limit]]
+        return short
+
+    def _inverted_lists(self):
+        """(rows, bounds) with the live rows of IVF list l at rows[bounds[l]:bounds[l + 1]]"""
+        if self._inverted is None:
+            lists = self._lists[:self.size]
+            rows = np.argsort(lists, kind="stable")
+            bounds = np.searchsorted(lists[rows], np.arange(self.ann.nlist + 1))
+            self._inverted = (rows, bounds)
+        return self._inverted
+
+    def _module_slice(self, conn, module_code):
+        """(rows, centroids) of the students on module_code's roster; None if it has none"""
+        generation = get_roster_generation(conn)
+        if generation != self.roster_generation:
+            self._slices = {}
+            self.roster_generation = generation
+        if module_code not in self._slices:
+            enrolled = [r[0] for r in conn.execute(
+                "SELECT student_id FROM enrolments WHERE module_code = ?", (module_code,))]
+            if enrolled:
+                rows = np.array(sorted(self._row_of[sid] for sid in enrolled if sid in self._row_of), dtype=np.intp)
+                self._slices[module_code] = (rows, self.matrix[rows])
+            else:
+                self._slices[module_code] = None
+        return self._slices[module_code]
+
+    def match(self, conn, probes, k=MATCH_TOP_K, student_ids=None, module_code=None, exact=False, nprobe=None):
+        """Score one probe vector or a batch of probes against the templates.
+
+        Returns one MatchResult per probe with up to k candidates, best first,
+        and the margin between the best and the runner-up score. A student's
+        score is their best individual enrolment template: centroids are
+        scored first and only the shortlist that could still make the top k
+        is re-ranked template by template. Ties are broken on student_id so
+        the answer never depends on row order. student_ids restricts the
+        search to those students only; module_code restricts it to the
+        module's roster, or searches everyone when the module has none.
+
+        Large enrolments go through the IVF index when one is loaded, only
+        scoring templates in the probe's nprobe nearest lists; small sets,
+        restricted searches and exact=True score every template in a single
+        matrix product.
+        """
+        probes = np.atleast_2d(np.asarray(probes, dtype=np.float32))
+        norms = np.linalg.norm(probes, axis=1, keepdims=True)
+        valid = norms[:, 0] > 0
+        probes = probes / np.where(norms == 0, 1, norms)
+
+        self.ensure_fresh(conn)
+        with self._lock:
+            ann, inverted = self.ann, None
+            templates = self.templates
+            restrict = None
+            if student_ids is not None:
+                restrict = [self._row_of[sid] for sid in student_ids if sid in self._row_of]
+                matrix = self.matrix[restrict]
+            elif module_code is not None:
+                module_slice = self._module_slice(conn, module_code)
+                if module_slice is not None:
+                    restrict, matrix = module_slice
+            if restrict is not None:
+                # Only copy out the restricted rows
+                ids = [self.student_ids[r] for r in restrict]
+                names = [self.names[r] for r in restrict]
+                tightness = self._tightness[restrict] if self.size else np.empty(0, dtype=np.float32)
+                radius = self._radius[restrict] if self.size else np.empty(0, dtype=np.float32)
+            else:
+                # Writers replace these arrays rather than mutate them, so
+                # views taken here stay valid once the lock is released
+                matrix = self.matrix
+                ids, names = self.student_ids, self.names
+                tightness = self._tightness[:self.size] if self.size else np.empty(0, dtype=np.float32)
+                radius = self._radius[:self.size] if self.size else np.empty(0, dtype=np.float32)
+                if ann is not None and self.size:
+                    inverted = self._inverted_lists()
+
+        empty = MatchResult([], 0.0)
+        if matrix.shape[0] == 0 or matrix.shape[1] != probes.shape[1]:
+            return [empty] * len(probes)
+
+        use_ann = (not exact and inverted is not None
+                   and matrix.shape[0] >= app.config['ANN_MIN_STUDENTS'])
+        if use_ann:
+            probe_lists = ann.nearest_lists(probes, nprobe or app.config['ANN_NPROBE'])
+        else:
+            scores = probes @ matrix.T
+
+        results = []
+        for p in range(len(probes)):
+            if not valid[p]:
+                results.append(empty)
+                continue
+            rows = None
+            if use_ann:
+                order, bounds = inverted
+                rows = np.concatenate([order[bounds[l]:bounds[l + 1]] for l in probe_lists[p]])
+                if rows.size < k:
+                    rows = None   # too few candidates, fall back to exact search
+            if rows is None:
+                row_scores = scores[p] if not use_ann else matrix @ probes[p]
+                rows = np.arange(matrix.shape[0])
+            else:
+                row_scores = matrix[rows] @ probes[p]
+
+            # Re-rank the centroid shortlist on each student's best template
+            short = rows[self._shortlist(row_scores, tightness[rows], radius[rows], k)]
+            blocks = [templates.get(ids[r]) for r in short]
+            blocks = [b if b is not None else matrix[r:r + 1] for b, r in zip(blocks, short)]
+            starts = np.cumsum([0] + [len(b) for b in blocks[:-1]])
+            best = np.maximum.reduceat(np.vstack(blocks) @ probes[p], starts)
+
+            ranked = sorted(range(short.size), key=lambda i: (-best[i], ids[short[i]]))[:k]
+            candidates = [Candidate(ids[short[i]], names[short[i]], float(best[i])) for i in ranked]
+            margin = candidates[0].score - candidates[1].score if len(candidates) > 1 else candidates[0].score
+            results.append(MatchResult(candidates, margin))
+        return results
+
+face_cache = FaceTemplateCache()
+
+# ---------- AGGREGATE CACHE ----------
+class AggregateCache:
+    """Small TTL + LRU cache for the dashboard aggregates.
+
+    Keys are (view, date, module, student) tuples, with None meaning "all".
+    Writes call invalidate() with the date, module and student they touched
+    and every entry that could depend on them is dropped: a check-in for
+    one student clears that student's dashboard, the dashboard for the
+    check-in's date and the recent check-ins list, nothing else.
+    Invalidation is per process, so the TTL bounds how stale an entry can
+    get when another worker did the write.
+
+    A value computed while an invalidation happened is returned but not
+    stored, so a slow query can never re-cache data a write just replaced.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (expires_at, value), oldest first
+        self._epoch = 0
+        self.counts = dict.fromkeys(("hits", "misses", "expired", "evicted", "invalidated"), 0)
+
+    def get(self, key, compute):
+        """Cached value for key, calling compute() on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.counts["hits"] += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+                self.counts["expired"] += 1
+            self.counts["misses"] += 1
+            epoch = self._epoch
+
+        value = compute()
+        with self._lock:
+            if epoch == self._epoch:
+                self._entries[key] = (now + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.counts["evicted"] += 1
+        return value
+
+    def invalidate(self, date=None, module=None, student=None):
+        """Drop entries that depend on a write to (date, module, student); all None clears everything"""
+        scope = (date, module, student)
+        with self._lock:
+            self._epoch += 1
+            stale = [key for key in self._entries
+                     if all(k is None or w is None or k == w for k, w in zip(key[1:], scope))]
+            for key in stale:
+                del self._entries[key]
+            self.counts["invalidated"] += len(stale)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counts["hits"] + self.counts["misses"]
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "ttl": self.ttl,
+                    **self.counts, "hit_rate": round(self.counts["hits"] / lookups, 4) if lookups else None}
+
+aggregate_cache = AggregateCache(app.config['AGGREGATE_CACHE_SIZE'], app.config['AGGREGATE_CACHE_TTL'])
+
+# ---------- BACKGROUND JOBS ----------
+class QueueFull(Exception):
+    """Raised when the job queue is at capacity; callers should ask the user to retry"""
+
+class Job:
+    """One unit of work on the JobQueue and its timings (monotonic seconds)"""
+
+    def __init__(self, owner=None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.future = None
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.progress = None   # JSON-able, set by long jobs through JobQueue.report_progress
+        self.lock = threading.Lock()
+        self.outcome = None    # (status, result) once finished
+        self.detached = False  # handed out for polling: outcome goes to job_results
+
+    @property
+    def status(self):
+        if not self.future.done():
+            return "queued" if self.started is None else "running"
+        return "failed" if self.future.exception() is not None else "done"
+
+class JobQueue:
+    """Bounded worker pool for the image work behind upload routes.
+
+    Decoding and detecting faces in a 12 MP phone photo can take longer
+    than a request should hold a web worker, so routes hand it to this
+    pool and wait up to JOB_TIMEOUT. At most workers + max_queued jobs are
+    admitted; beyond that submit() raises QueueFull immediately instead of
+    letting requests pile up. Threads are used rather than processes:
+    OpenCV and numpy release the GIL for the heavy parts, and jobs share
+    the template cache and connection pool. Each job runs in an app
+    context so it can use get_db_connection().
+
+    The queue itself is per process. Once a job is handed out for polling
+    (detach), its progress and outcome are also written to the job_results
+    table, so a poll that lands on another worker can still be answered.
+    Jobs whose request waits for the result never touch that table.
+    """
+
+    def __init__(self, workers, max_queued, result_ttl=300):
+        self.workers = workers
+        self.capacity = workers + max_queued
+        self.result_ttl = result_ttl
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._jobs = {}
+        self.queued = 0
+        self.running = 0
+        self.counts = dict.fromkeys(("submitted", "completed", "failed", "rejected", "timed_out"), 0)
+        self.waits = deque(maxlen=1000)       # seconds from submit to start
+        self.run_times = deque(maxlen=1000)   # seconds from start to finish
+
+    def submit(self, fn, *args, owner=None, **kwargs):
+        """Queue fn(*args, **kwargs) and return its Job, or raise QueueFull"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.counts["rejected"] += 1
+            raise QueueFull(f"{self.capacity} jobs already queued or running")
+        job = Job(owner)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+            cutoff = job.submitted - self.result_ttl
+            for job_id in [k for k, j in self._jobs.items() if j.finished is not None and j.finished < cutoff]:
+                del self._jobs[job_id]
+            self.queued += 1
+            self.counts["submitted"] += 1
+        job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        self._local.job = job
+        job.started = time.monotonic()
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.waits.append(job.started - job.submitted)
+        outcome = "failed"
+        try:
+            with app.app_context():
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception:
+                    self._settle(job, "failed")
+                    raise
+                self._settle(job, "done", result)
+            outcome = "completed"
+            return result
+        finally:
+            job.finished = time.monotonic()
+            with self._lock:
+                self.running -= 1
+                self.counts[outcome] += 1
+                self.run_times.append(job.finished - job.started)
+            self._slots.release()
+
+    def run(self, fn, *args, timeout=None, **kwargs):
+        """Submit and wait for the result.
+
+        Raises QueueFull, or FutureTimeout after `timeout` seconds (default
+        JOB_TIMEOUT); a timed-out job still runs to completion.
+        """
+        job = self.submit(fn, *args, **kwargs)
+        return self.wait(job, timeout)
+
+    def wait(self, job, timeout=None):
+        try:
+            return job.future.result(timeout=app.config['JOB_TIMEOUT'] if timeout is None else timeout)
+        except FutureTimeout:
+            with self._lock:
+                self.counts["timed_out"] += 1
+            raise
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def report_progress(self, progress):
+        """Publish the progress of the job running in this thread (JSON-able)"""
+        job = self._local.job
+        job.progress = progress
+        if job.detached:
+            save_job_result(get_db_connection(), job, "running", progress)
+
+    def _settle(self, job, status, result=None):
+        with job.lock:
+            job.outcome = (status, result)
+            detached = job.detached
+        if detached:
+            save_job_result(get_db_connection(), job, status, result)
+
+    def detach(self, job):
+        """Hand an owned job out for polling; from now on it is recorded in job_results"""
+        with job.lock:
+            job.detached = True
+            outcome = job.outcome
+        if outcome is None:
+            save_job_result(get_db_connection(), job, "running", job.progress, replace=False)
+        else:
+            save_job_result(get_db_connection(), job, *outcome)
+
+    def stats(self):
+        """Queue depth, counters and wait/run-time percentiles in milliseconds"""
+        with self._lock:
+            waits, run_times = list(self.waits), list(self.run_times)
+            stats = {"workers": self.workers, "capacity": self.capacity,
+                     "queued": self.queued, "running": self.running, **self.counts}
+        for name, samples in (("wait_ms", waits), ("run_ms", run_times)):
+            if samples:
+                p50, p95, top = np.percentile(samples, [50, 95, 100]) * 1000
+                stats[name] = {"p50": round(float(p50), 1), "p95": round(float(p95), 1), "max": round(float(top), 1)}
+        return stats
+
+jobs = JobQueue(app.config['JOB_WORKERS'], app.config['JOB_QUEUE_SIZE'], app.config['JOB_RESULT_TTL'])
+# One web bulk import at a time, kept off the check-in workers
+bulk_jobs = JobQueue(1, 0, app.config['JOB_RESULT_TTL'])
+# Eager thumbnail generation, best effort and likewise off the check-in workers
+thumbnail_jobs = JobQueue(1, 32, app.config['JOB_RESULT_TTL'])
+
+def save_job_result(conn, job, status, result=None, replace=True):
+    """Record an owned job's status (and JSON result) in job_results.
+
+    replace=False only records the job if nothing is stored for it yet, so
+    marking a job "running" can never overwrite its finished outcome.
+    Rows older than JOB_RESULT_TTL are pruned on the way.
+    """
+    now = time.time()
+    verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+    try:
+        conn.execute(f"{verb} INTO job_results (job_id, owner, status, result, updated_at) VALUES (?, ?, ?, ?, ?)",
+                     (job.id, job.owner, status, None if result is None else json.dumps(result), now))
+        conn.execute("DELETE FROM job_results WHERE updated_at < ?", (now - app.config['JOB_RESULT_TTL'],))
+        conn.commit()
+    except (sqlite3.Error, TypeError, ValueError) as e:
+        conn.rollback()
+        print(f"Could not record the outcome of job {job.id}: {e}")
+
+def load_job_result(conn, job_id, owner):
+    """(status, result) stored for one of owner's jobs, or None"""
+    row = conn.execute("SELECT status, result FROM job_results WHERE job_id = ? AND owner = ?",
+                       (job_id, owner)).fetchone()
+    if row is None:
+        return None
+    return row['status'], None if row['result'] is None else json.loads(row['result'])
+
+def job_outcome(job_id, owner):
+    """(status, data) of one of owner's jobs queued by any worker, or None.
+
+    data is the result once the job is done, otherwise its latest progress
+    (or None). Jobs queued by this worker are answered from memory, others
+    from the job_results table.
+    """
+    for queue in (jobs, bulk_jobs):
+        job = queue.get(job_id)
+        if job is not None and job.owner == owner:
+            status = job.status
+            return status, job.future.result() if status == "done" else job.progress
+    return load_job_result(get_db_connection(), job_id, owner)
+
+def run_image_job(fn, *args):
+    """Run image work on the job queue; returns (result, error message)"""
+    try:
+        return jobs.run(fn, *args), None
+    except QueueFull:
+        return None, "The server is busy processing other photos. Please try again in a moment."
+    except FutureTimeout:
+        return None, "Processing the photo took too long. Please try again with a smaller photo."
+
+# ---------- BULK ENROLMENT ----------
+BULK_REQUIRED_COLUMNS = ("student_id", "name", "mobile", "password")
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+class PhotoSource:
+    """Roster photos in a folder or a zip archive, looked up by file name.
+
+    A roster row can name its photo in a "photo" column; otherwise a file
+    called <student_id>.<ext> is used.
+    """
+
+    _open_sources = {}   # per-process cache used by the extraction workers
+
+    def __init__(self, path):
+        self.path = path
+        self.is_zip = zipfile.is_zipfile(path)
+        if self.is_zip:
+            self._zip = zipfile.ZipFile(path)
+            names = [n for n in self._zip.namelist() if not n.endswith("/")]
+        else:
+            names = [os.path.join(root, f) for root, _, files in os.walk(path) for f in files]
+        self._by_name = {}
+        self._by_stem = {}
+        for name in names:
+            base = os.path.basename(name).lower()
+            self._by_name.setdefault(base, name)
+            stem, ext = os.path.splitext(base)
+            if ext in PHOTO_EXTENSIONS:
+                self._by_stem.setdefault(stem, name)
+
+    @classmethod
+    def open_cached(cls, path):
+        if path not in cls._open_sources:
+            cls._open_sources[path] = cls(path)
+        return cls._open_sources[path]
+
+    def find(self, student_id, filename=""):
+        if filename:
+            return self._by_name.get(os.path.basename(filename).lower())
+        return self._by_stem.get(student_id.lower())
+
+    def read(self, key):
+        if self.is_zip:
+            return self._zip.read(key)
+        with open(key, "rb") as f:
+            return f.read()
+
+    def close(self):
+        if self.is_zip:
+            self._zip.close()
+
+    def copy_to(self, key, dest_path):
+        if self.is_zip:
+            with self._zip.open(key) as src, open(dest_path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        else:
+            shutil.copyfile(key, dest_path)
+
+def _bulk_extract(item):
+    """Process-pool worker: read, quality-gate and extract one roster photo.
+
+    Returns (features, reason); reason says why features is None.
+    """
+    source_path, key = item
+    try:
+        features, report = timed_extract(PhotoSource.open_cached(source_path).read(key), "bulk_import")
+    except Exception as e:
+        print(f"Error in feature extraction for {key}: {e}")
+        return None, "could not process photo"
+    if report.reason:
+        return None, report.message
+    return features, None if features is not None else "could not process photo"
+
+def bulk_enrol(conn, roster, photos, workers=None, batch_size=100, progress=None):
+    """Enrol every student in a roster CSV, extracting features in parallel.
+
+    Rows are processed in batches: photos go through a process pool and each
+    batch is inserted and committed in one transaction. Students that are
+    already enrolled are skipped, so re-running an interrupted import picks
+    up where it stopped. An optional "modules" column (codes separated by
+    spaces or semicolons) puts each new student on those module rosters.
+    Returns a dict with enrolled / skipped counts and a list of
+    (line, student_id, reason) failures.
+    """
+    reader = csv.DictReader(roster)
+    missing = [c for c in BULK_REQUIRED_COLUMNS if c not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f"Roster is missing column(s): {', '.join(missing)}")
+
+    result = {"enrolled": 0, "skipped": 0, "failures": []}
+    pool = None
+    if workers != 1:
+        # Imported here: only bulk imports need the multiprocessing machinery
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        batch = []
+        for row in reader:
+            batch.append((reader.line_num, row))
+            if len(batch) >= batch_size:
+                _enrol_batch(conn, batch, photos, pool, result)
+                batch = []
+                if progress:
+                    progress(result)
+        if batch:
+            _enrol_batch(conn, batch, photos, pool, result)
+            if progress:
+                progress(result)
+    finally:
+        if pool:
+            pool.shutdown()
+
+    if result["enrolled"]:
+        face_cache.invalidate()
+    return result
+
+def _enrol_batch(conn, batch, photos, pool, result):
+    ids = [(row.get("student_id") or "").strip() for _, row in batch]
+    existing = registered_student_ids(conn, ids)
+    modules = get_modules(conn)
+
+    work, queued = [], set()
+    for line, row in batch:
+        values = {c: (row.get(c) or "").strip() for c in BULK_REQUIRED_COLUMNS}
+        student_id = values["student_id"]
+        module_codes = (row.get("modules") or "").replace(";", " ").split()
+        if not all(values.values()):
+            result["failures"].append((line, student_id, "missing required field(s)"))
+        elif any(code not in modules for code in module_codes):
+            result["failures"].append((line, student_id, "unknown module code"))
+        elif student_id in existing:
+            result["skipped"] += 1
+        elif student_id in queued:
+            result["failures"].append((line, student_id, "duplicate student ID in roster"))
+        else:
+            key = photos.find(student_id, (row.get("photo") or "").strip())
+            if key is None:
+                result["failures"].append((line, student_id, "photo not found"))
+            else:
+                queued.add(student_id)
+                work.append((line, values, key, module_codes))
+
+    items = [(photos.path, key) for _, _, key, _ in work]
+    all_features = pool.map(_bulk_extract, items, chunksize=4) if pool else map(_bulk_extract, items)
+
+    # Photos are copied under a temporary name and only renamed into place
+    # once the batch commits, so a failed batch leaves no orphaned uploads
+    enrolled, staged = [], []
+    try:
+        for (line, values, key, module_codes), (features, reason) in zip(work, all_features):
+            if features is None:
+                result["failures"].append((line, values["student_id"], reason))
+                continue
+            ext = os.path.splitext(key)[1].lower()
+            filename = f"{values['student_id']}_{uuid.uuid4().hex[:8]}{ext if ext in PHOTO_EXTENSIONS else '.jpg'}"
+            photo_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            staged.append(photo_path)
+            photos.copy_to(key, photo_path + ".part")
+            conn.execute("""
+                INSERT INTO students (student_id, name, mobile, password, photo_path, face_encoding) 
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (values["student_id"], values["name"], values["mobile"], values["password"],
+                  photo_path, encode_template(features)))
+            store_face_templates(conn, values["student_id"], [(features, photo_path)])
+            conn.executemany("INSERT OR IGNORE INTO enrolments (module_code, student_id) VALUES (?, ?)",
+                             [(code, values["student_id"]) for code in module_codes])
+            enrolled.append(values["student_id"])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        for photo_path in staged:
+            if os.path.exists(photo_path + ".part"):
+                os.remove(photo_path + ".part")
+        raise
+    for photo_path in staged:
+        os.replace(photo_path + ".part", photo_path)
+    result["enrolled"] += len(enrolled)
+    for student_id in enrolled:
+        aggregate_cache.invalidate(student=student_id)
+
+# ---------- CLI COMMANDS ----------
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the database schema and apply pending migrations"""
+    init_db()
+    click.echo(f"{DB_NAME} is at schema version {len(SCHEMA_MIGRATIONS)}.")
+
+@app.cli.command("build-ann-index")
+@click.option("--nlist", type=int, default=None, help="Number of IVF lists (default 4*sqrt(N)).")
+def build_ann_index_command(nlist):
+    """Train and save the approximate nearest-neighbour index"""
+    conn = get_db_connection()
+    index = face_cache.build_ann(conn, nlist)
+    if index is None:
+        click.echo("No face templates enrolled, nothing to index.")
+    else:
+        click.echo(f"Built IVF index with {index.nlist} lists over {face_cache.size} templates "
+                   f"-> {app.config['ANN_INDEX_PATH']}")
+
+@app.cli.command("ann-recall")
+@click.option("--queries", type=int, default=200, help="Number of sampled probes.")
+@click.option("--noise", type=float, default=0.05, help="Norm of the noise added to each sampled template.")
+@click.option("--k", "k", type=int, default=MATCH_TOP_K)
+@click.option("--nprobe", type=int, default=None, help="Override ANN_NPROBE for this run.")
+def ann_recall_command(queries, noise, k, nprobe):
+    """Measure ANN recall@k and latency against exact search"""
+    conn = get_db_connection()
+    face_cache.ensure_fresh(conn)
+    if face_cache.ann is None:
+        click.echo("No ANN index loaded; run `flask build-ann-index` first.")
+        return
+
+    rng = np.random.default_rng(0)
+    sample = rng.choice(face_cache.size, min(queries, face_cache.size), replace=False)
+    probes = face_cache.matrix[sample].copy()
+    jitter = rng.standard_normal(probes.shape).astype(np.float32)
+    probes += noise * jitter / np.linalg.norm(jitter, axis=1, keepdims=True)
+
+    # Force the ANN path regardless of ANN_MIN_STUDENTS for the measurement
+    min_students = app.config['ANN_MIN_STUDENTS']
+    app.config['ANN_MIN_STUDENTS'] = 0
+    try:
+        start = time.perf_counter()
+        approx = face_cache.match(conn, probes, k=k, nprobe=nprobe)
+        ann_ms = (time.perf_counter() - start) * 1000 / len(probes)
+    finally:
+        app.config['ANN_MIN_STUDENTS'] = min_students
+    start = time.perf_counter()
+    exact = [face_cache.match(conn, probe, k=k, exact=True)[0] for probe in probes]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(probes)
+
+    hits = total = top1 = 0
+    for a, e in zip(approx, exact):
+        truth = {c.student_id for c in e.candidates}
+        hits += len(truth & {c.student_id for c in a.candidates})
+        total += len(truth)
+        top1 += bool(a.candidates and e.candidates and a.candidates[0].student_id == e.candidates[0].student_id)
+
+    click.echo(f"nprobe={nprobe or app.config['ANN_NPROBE']} lists={face_cache.ann.nlist} templates={face_cache.size}")
+    click.echo(f"recall@{k}: {hits / max(total, 1):.4f}  top-1 agreement: {top1 / len(probes):.4f}")
+    click.echo(f"latency per probe: ann {ann_ms:.3f} ms, exact {exact_ms:.3f} ms")
+
+@app.cli.command("migrate-templates")
+@click.option("--dtype", type=click.Choice(sorted(TEMPLATE_DTYPE_CODES)), default=None,
+              help="Target precision (default TEMPLATE_DTYPE).")
+@click.option("--vacuum", is_flag=True, help="VACUUM the database afterwards to reclaim space.")
+def migrate_templates_command(dtype, vacuum):
+    """Convert stored face templates to the compact binary format"""
+    conn = get_db_connection()
+    size_sql = " + ".join(f"(SELECT COALESCE(SUM(LENGTH({column})), 0) FROM {table})"
+                          for table, column in TEMPLATE_COLUMNS)
+    before = conn.execute(f"SELECT {size_sql}").fetchone()[0]
+    migrated = migrate_face_templates(conn, dtype)
+    after = conn.execute(f"SELECT {size_sql}").fetchone()[0]
+    if vacuum:
+        conn.execute("VACUUM")
+    click.echo(f"Re-encoded {migrated} templates: {before / 1024:.1f} KB -> {after / 1024:.1f} KB")
+
+def stored_template_rows(conn):
+    """Every enrolment template, plus the profile photo of students who have none.
+
+    Rows are (id, student_id, photo_path, template); id is NULL for the
+    profile-photo rows, which have no face_templates row yet.
+    """
+    return conn.execute("""
+        SELECT id, student_id, photo_path, template FROM face_templates
+        UNION ALL
+        SELECT NULL, student_id, photo_path, face_encoding FROM students
+        WHERE photo_path IS NOT NULL
+          AND student_id NOT IN (SELECT student_id FROM face_templates)
+    """).fetchall()
+
+@app.cli.command("fit-projection")
+@click.option("--components", type=int, default=128, show_default=True, help="Dimensions to keep.")
+@click.option("--drop-unencodable", is_flag=True,
+              help="Delete templates that cannot be re-encoded instead of refusing to fit.")
+def fit_projection_command(components, drop_unencodable):
+    """Fit the PCA projection and re-encode every student with it.
+
+    A template with neither its photo nor a raw-space copy cannot be moved
+    into the new space, and one left at the old width would knock the
+    other students out of the template cache. Unless --drop-unencodable is
+    given, nothing is changed while any such template remains.
+    """
+    conn = get_db_connection()
+    rows = stored_template_rows(conn)
+
+    # Raw vectors come from the stored photo, or from a template that is
+    # still in raw pixel space when the photo is gone.
+    raw_dim = FACE_SIZE[0] * FACE_SIZE[1]
+    kept, raw, skipped = [], [], []
+    for row in rows:
+        features = None
+        photo_path = stored_photo_path(row['photo_path'])
+        if photo_path and os.path.isfile(photo_path):
+            features = extract_face_features(photo_path, project=False)
+        if features is None:
+            stored = decode_template(row['template'])
+            if stored is not None and stored.shape[0] == raw_dim:
+                features = stored
+        if features is None:
+            skipped.append(row)
+            continue
+        kept.append(row)
+        raw.append(features)
+
+    skipped_students = sorted({row['student_id'] for row in skipped})
+    if skipped and not drop_unencodable:
+        raise click.ClickException(
+            f"No photo or raw template for: {', '.join(skipped_students)}. Re-upload their photos, "
+            f"or re-run with --drop-unencodable to delete those templates.")
+
+    try:
+        projection = FaceProjection.fit(np.vstack(raw) if raw else np.empty((0, raw_dim)), components)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    projection.save(app.config['PROJECTION_PATH'])
+    encoded = projection.apply(np.vstack(raw))
+    by_student = {}
+    for vec, row in zip(encoded, kept):
+        by_student.setdefault(row['student_id'], []).append(vec)
+        if row['id'] is None:
+            conn.execute("INSERT INTO face_templates (student_id, template, photo_path) VALUES (?, ?, ?)",
+                         (row['student_id'], encode_template(vec), row['photo_path']))
+        else:
+            conn.execute("UPDATE face_templates SET template = ? WHERE id = ?", (encode_template(vec), row['id']))
+    conn.executemany("UPDATE students SET face_encoding = ? WHERE student_id = ?",
+                     [(encode_template(template_centroid(vecs)[0]), student_id)
+                      for student_id, vecs in by_student.items()])
+    # Templates left in the old space go; a student with none left in the
+    # new space is unenrolled until they re-upload a photo
+    conn.executemany("DELETE FROM face_templates WHERE id = ?",
+                     [(row['id'],) for row in skipped if row['id'] is not None])
+    conn.executemany("UPDATE students SET face_encoding = NULL WHERE student_id = ?",
+                     [(student_id,) for student_id in skipped_students if student_id not in by_student])
+    conn.commit()
+
+    # The IVF index lives in the old feature space
+    if os.path.exists(app.config['ANN_INDEX_PATH']):
+        os.remove(app.config['ANN_INDEX_PATH'])
+        click.echo("Removed the ANN index; rebuild it with `flask build-ann-index`.")
+    face_cache.invalidate()
+
+    click.echo(f"Fitted {projection.dim}-dimension projection and re-encoded {len(kept)} templates "
+               f"for {len(by_student)} students "
+               f"-> {app.config['PROJECTION_PATH']}")
+    if skipped:
+        click.echo(f"Dropped {len(skipped)} templates with no photo or raw template for: "
+                   f"{', '.join(skipped_students)} (re-upload their photos)")
+
+@app.cli.command("reextract-templates")
+def reextract_templates_command():
+    """Re-extract every template from its stored photo with the current extractor.
+
+    Run after a change to detection or cropping: templates extracted the
+    old way no longer match probes extracted the new way. A template whose
+    photo is missing, or has no usable face, is kept as it is.
+    """
+    conn = get_db_connection()
+    by_student, kept = {}, {}
+    updated, stale = 0, []
+    for row in stored_template_rows(conn):
+        features = None
+        photo_path = stored_photo_path(row['photo_path'])
+        if photo_path and os.path.isfile(photo_path):
+            features = extract_face_features(photo_path)
+        if features is None:
+            stale.append(row['student_id'])
+            vec = decode_template(row['template'])
+            if vec is not None:
+                kept.setdefault(row['student_id'], []).append(vec.astype(np.float32))
+            continue
+        blob = encode_template(features)
+        if row['id'] is None:
+            conn.execute("INSERT INTO face_templates (student_id, template, photo_path) VALUES (?, ?, ?)",
+                         (row['student_id'], blob, row['photo_path']))
+        else:
+            conn.execute("UPDATE face_templates SET template = ? WHERE id = ?", (blob, row['id']))
+        by_student.setdefault(row['student_id'], []).append(decode_template(blob).astype(np.float32))
+        updated += 1
+
+    # Centroids over the new templates and any kept ones of the same width
+    centroids = []
+    for student_id, vecs in by_student.items():
+        vecs += [vec for vec in kept.get(student_id, ()) if vec.shape == vecs[0].shape]
+        centroids.append((encode_template(template_centroid(np.vstack(vecs))[0]), student_id))
+    conn.executemany("UPDATE students SET face_encoding = ? WHERE student_id = ?", centroids)
+    conn.commit()
+    face_cache.invalidate()
+
+    click.echo(f"Re-extracted {updated} templates for {len(by_student)} students")
+    if stale:
+        click.echo(f"Kept the old template (photo missing or no usable face) for: "
+                   f"{', '.join(sorted(set(stale)))} (re-upload their photos)")
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recompute the attendance summary tables from scratch"""
+    conn = get_db_connection()
+    rebuild_attendance_rollups(conn)
+    conn.commit()
+    click.echo("Attendance rollups rebuilt.")
+
+@app.cli.command("bulk-import")
+@click.argument("roster", type=click.File("r", encoding="utf-8-sig"))
+@click.argument("photos", type=click.Path(exists=True))
+@click.option("--workers", type=int, default=None, help="Extraction processes (default: CPU count).")
+@click.option("--batch-size", type=int, default=100, show_default=True, help="Rows per transaction.")
+def bulk_import_command(roster, photos, workers, batch_size):
+    """Enrol students from a roster CSV and a folder or zip of photos"""
+    conn = get_db_connection()
+    start = time.perf_counter()
+    try:
+        result = bulk_enrol(conn, roster, PhotoSource(photos), workers, batch_size,
+                            progress=lambda r: click.echo(f"  enrolled {r['enrolled']}, skipped {r['skipped']}, "
+                                                          f"failed {len(r['failures'])}"))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    for line, student_id, reason in result["failures"]:
+        click.echo(f"line {line}: {student_id or '?'}: {reason}", err=True)
+    click.echo(f"Enrolled {result['enrolled']}, skipped {result['skipped']} already enrolled, "
+               f"{len(result['failures'])} failed in {time.perf_counter() - start:.1f}s")
+
+@app.cli.command("enrol")
+@click.argument("module_code")
+@click.argument("roster", type=click.File("r", encoding="utf-8-sig"))
+@click.option("--replace", is_flag=True, help="Take students not in the roster off the module.")
+def enrol_command(module_code, roster, replace):
+    """Put the student IDs in a roster CSV (first column) on a module"""
+    conn = get_db_connection()
+    if module_code not in get_modules(conn):
+        raise click.ClickException(f"Unknown module {module_code}")
+    added, removed, unknown = enrol_students(conn, module_code, read_roster_ids(roster), replace=replace)
+    conn.commit()
+    if unknown:
+        click.echo(f"Not registered: {', '.join(unknown)}", err=True)
+    click.echo(f"{module_code}: {added} enrolled, {removed} removed, {len(unknown)} unknown")
 
 # ---------- ROUTES ----------
 @app.route("/")
@@ -154,10 +2772,8 @@ def lecturer_login():
         staff_id = request.form["staff_id"]
         password = request.form["password"]
         conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM lecturers WHERE staff_id=? AND password=?", (staff_id, password))
-        lecturer = cur.fetchone()
-        conn.close()
+        lecturer = conn.execute("SELECT * FROM lecturers WHERE staff_id=? AND password=?",
+                                (staff_id, password)).fetchone()
         
         if lecturer:
             session["lecturer"] = staff_id
@@ -175,10 +2791,8 @@ def student_login():
         student_id = request.form["student_id"]
         password = request.form["password"]
         conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM students WHERE student_id=? AND password=?", (student_id, password))
-        student = cur.fetchone()
-        conn.close()
+        student = conn.execute("SELECT * FROM students WHERE student_id=? AND password=?",
+                               (student_id, password)).fetchone()
         
         if student:
             session["student"] = student_id
@@ -193,68 +2807,79 @@ def student_login():
 @app.route("/dashboard")
 @lecturer_required
 def dashboard():
-    # Get attendance statistics
-    conn = get_db_connection()
-    
-    # Count total students
-    total_students = conn.execute("SELECT COUNT(*) FROM students").fetchone()[0]
-    
     # Count today's attendance per module
     today = datetime.now().strftime("%Y-%m-%d")
     
-    # Get module-wise attendance for today
-    module_attendance = conn.execute("""
-        SELECT module_code, COUNT(DISTINCT student_id) as present_count 
-        FROM attendance 
-        WHERE date = ? 
-        GROUP BY module_code
-    """, (today,)).fetchall()
-    
-    # Get recent attendance
-    recent_attendance = conn.execute("""
-        SELECT a.student_id, s.name, a.date, a.time, a.module_code 
-        FROM attendance a 
-        JOIN students s ON a.student_id = s.student_id 
-        ORDER BY a.id DESC 
-        LIMIT 5
-    """).fetchall()
+    # Get attendance statistics (cached until a student or today's attendance changes)
+    def load_today():
+        conn = get_db_connection()
+        
+        # Count total students
+        total_students = conn.execute("SELECT COUNT(*) FROM students").fetchone()[0]
+        
+        # Get module-wise attendance for today
+        module_attendance = conn.execute("""
+            SELECT module_code, present_count 
+            FROM daily_module_attendance 
+            WHERE date = ? 
+            ORDER BY module_code
+        """, (today,)).fetchall()
+        return total_students, module_attendance
     
-    conn.close()
+    # Get recent attendance. The newest rows can be from any date (a kiosk
+    # syncing yesterday's captures), so this is cached under an all-dates
+    # key that every attendance write clears.
+    def load_recent():
+        return get_db_connection().execute("""
+            SELECT a.student_id, s.name, a.date, a.time, a.module_code 
+            FROM attendance a 
+            JOIN students s ON a.student_id = s.student_id 
+            ORDER BY a.id DESC 
+            LIMIT 5
+        """).fetchall()
+    
+    total_students, module_attendance = aggregate_cache.get(("dashboard", today, None, None), load_today)
+    recent_attendance = aggregate_cache.get(("recent_attendance", None, None, None), load_recent)
     
     return render_template("dashboard.html", 
                            total_students=total_students,
                            module_attendance=module_attendance,
                            recent_attendance=recent_attendance,
-                           modules=MODULES)
+                           modules=get_modules(get_db_connection()))
 
 @app.route("/student_dashboard")
 @student_required
 def student_dashboard():
-    conn = get_db_connection()
+    student_id = session["student"]
     
-    # Get recent attendance for this student
-    recent_attendance = conn.execute("""
-        SELECT date, time, module_code 
-        FROM attendance 
-        WHERE student_id = ? 
-        ORDER BY date DESC, time DESC 
-        LIMIT 5
-    """, (session["student"],)).fetchall()
-    
-    # Get module-wise attendance summary for this student
-    module_summary = conn.execute("""
-        SELECT module_code, COUNT(*) as days_present
-        FROM attendance 
-        WHERE student_id = ? 
-        GROUP BY module_code
-    """, (session["student"],)).fetchall()
+    # Cached until this student's attendance changes
+    def load():
+        conn = get_db_connection()
+        
+        # Get recent attendance for this student
+        recent_attendance = conn.execute("""
+            SELECT date, time, module_code 
+            FROM attendance 
+            WHERE student_id = ? 
+            ORDER BY date DESC, time DESC 
+            LIMIT 5
+        """, (student_id,)).fetchall()
+        
+        # Get module-wise attendance summary for this student
+        module_summary = conn.execute("""
+            SELECT module_code, COUNT(*) as days_present
+            FROM attendance 
+            WHERE student_id = ? 
+            GROUP BY module_code
+        """, (student_id,)).fetchall()
+        return recent_attendance, module_summary
     
-    conn.close()
+    recent_attendance, module_summary = aggregate_cache.get(("student_dashboard", None, None, student_id), load)
     
     return render_template("student_dashboard.html", 
                           recent_attendance=recent_attendance,
                           module_summary=module_summary,
-                          modules=MODULES)
+                          modules=get_modules(get_db_connection()))
 
 @app.route("/logout")
 def logout():
@@ -284,55 +2909,205 @@ def register_student():
         
         if existing_student:
             flash("Student ID already exists! Please use a different ID.", "danger")
-            conn.close()
             return redirect("/register_student")
         
-        # Process image
+        # Process images (one or more enrolment photos)
         if 'photo' not in request.files:
             flash("No photo uploaded", "danger")
             return redirect("/register_student")
             
-        file = request.files['photo']
-        if file.filename == '':
+        files = [f for f in request.files.getlist('photo') if f.filename]
+        if not files:
             flash("No selected file", "danger")
             return redirect("/register_student")
             
-        # Save file with unique name
-        filename = f"{student_id}_{uuid.uuid4().hex[:8]}.jpg"
-        photo_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(photo_path)
+        # Extract features from the uploaded bytes on the job queue
+        enrolments = []
+        for file in files:
+            photo_bytes = file.read()
+            extracted, error = run_image_job(timed_extract, photo_bytes, "register_student")
+            if error:
+                flash(error, "warning")
+                return redirect("/register_student")
+            features, report = extracted
+            if report.reason:
+                flash(f"{file.filename}: {report.message}", "warning")
+                return redirect("/register_student")
+            if features is None:
+                flash(f"Error processing image {file.filename}. Please try again.", "danger")
+                return redirect("/register_student")
+            enrolments.append((features, photo_bytes))
         
-        # Extract features
-        features = extract_face_features(photo_path)
-        
-        if features is None:
-            flash("Error processing image. Please try again.", "danger")
-            os.remove(photo_path)
-            return redirect("/register_student")
+        # Save files with unique names; the first photo is the profile photo
+        saved = []
+        for features, photo_bytes in enrolments:
+            filename = f"{student_id}_{uuid.uuid4().hex[:8]}.jpg"
+            photo_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            with open(photo_path, "wb") as f:
+                f.write(photo_bytes)
+            saved.append((features, photo_path))
         
-        # Save to database with password
+        # Save to database with password; face_encoding is the templates' centroid
+        templates = [np.asarray(features, dtype=np.float32) for features, _ in saved]
         conn.execute("""
             INSERT INTO students (student_id, name, mobile, password, photo_path, face_encoding) 
             VALUES (?, ?, ?, ?, ?, ?)
-        """, (student_id, name, mobile, password, photo_path, pickle.dumps(features)))
+        """, (student_id, name, mobile, password, saved[0][1], encode_template(template_centroid(templates)[0])))
+        templates, _ = store_face_templates(conn, student_id, saved)
         
         conn.commit()
-        conn.close()
+        face_cache.upsert(conn, student_id, name, templates)
+        aggregate_cache.invalidate(student=student_id)
+        queue_thumbnails(saved[0][1])
         
         flash(f"Student {name} registered successfully!", "success")
         return redirect("/view_students")
     
     return render_template("register_student.html")
 
+# CREATE - Bulk enrolment from a roster CSV plus a zip of photos
+@app.route("/bulk_register", methods=["GET", "POST"])
+@lecturer_required
+def bulk_register():
+    if request.method == "POST":
+        roster = request.files.get('roster')
+        photos = request.files.get('photos')
+        if not roster or not roster.filename or not photos or not photos.filename:
+            flash("Please upload both the roster CSV and the photo zip.", "danger")
+            return redirect("/bulk_register")
+        
+        try:
+            roster_text = roster.stream.read().decode("utf-8-sig")
+        except UnicodeDecodeError:
+            flash("The roster must be a UTF-8 CSV file.", "danger")
+            return redirect("/bulk_register")
+        rows = [row for row in csv.reader(io.StringIO(roster_text)) if row]
+        missing = [c for c in BULK_REQUIRED_COLUMNS if c not in (rows[0] if rows else [])]
+        if missing:
+            flash(f"Roster is missing column(s): {', '.join(missing)}", "danger")
+            return redirect("/bulk_register")
+        total = len(rows) - 1
+        if total > app.config['BULK_WEB_MAX_ROWS']:
+            flash(f"The roster has {total} students; web imports take at most {app.config['BULK_WEB_MAX_ROWS']}. "
+                  f"Split it, or run `flask bulk-import` on the server.", "warning")
+            return redirect("/bulk_register")
+        
+        # The import runs after this request, so the archive has to be on disk
+        with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp:
+            photos.save(tmp)
+        if not zipfile.is_zipfile(tmp.name):
+            os.remove(tmp.name)
+            flash("Photos must be uploaded as a .zip archive.", "danger")
+            return redirect("/bulk_register")
+        try:
+            job = bulk_jobs.submit(run_bulk_import, roster_text, tmp.name, total, owner=session["lecturer"])
+        except QueueFull:
+            os.remove(tmp.name)
+            flash("Another bulk import is still running. Please try again when it has finished.", "warning")
+            return redirect("/bulk_register")
+        bulk_jobs.detach(job)
+        return redirect(f"/bulk_register?job={job.id}")
+    
+    job_id = request.args.get("job")
+    if not job_id:
+        return render_template("bulk_register.html", result=None)
+    outcome = job_outcome(job_id, session["lecturer"])
+    if outcome is None:
+        flash("The result of that import is no longer available.", "warning")
+        return render_template("bulk_register.html", result=None)
+    status, data = outcome
+    if status == "failed" or (status == "done" and "error" in data):
+        flash(data["error"] if status == "done" else "The import failed. Please try again.", "danger")
+        return render_template("bulk_register.html", result=None)
+    if status == "done":
+        flash(f"Enrolled {data['enrolled']} students, skipped {data['skipped']} already enrolled, "
+              f"{len(data['failures'])} failed.", "success" if not data['failures'] else "warning")
+        return render_template("bulk_register.html", result=data)
+    return render_template("bulk_register.html", result=None, job_id=job_id, progress=data)
+
+def run_bulk_import(roster_text, zip_path, total):
+    """Bulk-import job: enrol a roster from an uploaded zip, reporting progress after each batch.
+
+    Extraction is serial on the job thread; a process pool per request
+    would compete with the web workers for every core.
+    """
+    source = PhotoSource(zip_path)
+    try:
+        return bulk_enrol(get_db_connection(), io.StringIO(roster_text), source, workers=1,
+                          progress=lambda r: bulk_jobs.report_progress(
+                              {"total": total, "enrolled": r["enrolled"], "skipped": r["skipped"],
+                               "failed": len(r["failures"])}))
+    except ValueError as e:
+        return {"error": str(e)}
+    finally:
+        source.close()
+        os.remove(zip_path)
+
 # READ - View All Students
+STUDENTS_PER_PAGE = 25
+
+def parse_student_cursor(value):
+    """Split a "created_at,id" keyset cursor, or None if it is missing or malformed"""
+    try:
+        created_at, row_id = value.rsplit(",", 1)
+        return created_at, int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
 @app.route("/view_students")
 @lecturer_required
 def view_students():
+    search = request.args.get('q', '').strip()
+    after = parse_student_cursor(request.args.get('after'))
+    before = parse_student_cursor(request.args.get('before'))
+    
     conn = get_db_connection()
-    students = conn.execute("SELECT * FROM students ORDER BY created_at DESC").fetchall()
-    conn.close()
     
-    return render_template("view_students.html", students=students)
+    # Keyset pagination on (created_at, id), newest first. The face_encoding
+    # BLOB is never selected.
+    query = "SELECT id, student_id, name, mobile, photo_path, created_at FROM students WHERE 1=1"
+    params = []
+    
+    if search:
+        # One prefix range search per NOCASE index, rather than an OR that
+        # the planner may answer by scanning the whole table in page order
+        pattern = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        query += """ AND id IN (SELECT id FROM students WHERE student_id LIKE ? ESCAPE '\\'
+                                UNION SELECT id FROM students WHERE name LIKE ? ESCAPE '\\')"""
+        params.extend([pattern, pattern])
+    
+    if before:
+        query += " AND (created_at, id) > (?, ?) ORDER BY created_at ASC, id ASC"
+        params.extend(before)
+    else:
+        if after:
+            query += " AND (created_at, id) < (?, ?)"
+            params.extend(after)
+        query += " ORDER BY created_at DESC, id DESC"
+    
+    query += " LIMIT ?"
+    params.append(STUDENTS_PER_PAGE + 1)
+    
+    students = conn.execute(query, params).fetchall()
+    more = len(students) > STUDENTS_PER_PAGE
+    students = students[:STUDENTS_PER_PAGE]
+    
+    if before:
+        students.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = after is not None, more
+    
+    prev_cursor = f"{students[0]['created_at']},{students[0]['id']}" if students and has_prev else None
+    next_cursor = f"{students[-1]['created_at']},{students[-1]['id']}" if students and has_next else None
+    total_students = conn.execute("SELECT COUNT(*) FROM students").fetchone()[0]
+    
+    return render_template("view_students.html",
+                           students=students,
+                           total_students=total_students,
+                           search=search,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor)
 
 # READ - View Single Student
 @app.route("/student/<int:student_id>")
@@ -341,23 +3116,23 @@ def view_student(student_id):
     conn = get_db_connection()
     student = conn.execute("SELECT * FROM students WHERE id = ?", (student_id,)).fetchone()
     
-    # Get student's module-wise attendance
-    module_attendance = conn.execute("""
-        SELECT module_code, COUNT(*) as days_present,
-               (SELECT COUNT(DISTINCT date) FROM attendance WHERE module_code = a.module_code) as total_days,
-               ROUND(COUNT(*) * 100.0 / (SELECT COUNT(DISTINCT date) FROM attendance WHERE module_code = a.module_code), 2) as attendance_rate
-        FROM attendance a
-        WHERE student_id = ?
-        GROUP BY module_code
-    """, (student['student_id'],)).fetchall()
-    
-    conn.close()
-    
     if student is None:
         flash("Student not found!", "danger")
         return redirect("/view_students")
     
-    return render_template("view_student.html", student=student, module_attendance=module_attendance, modules=MODULES)
+    # Get student's module-wise attendance from the rollup tables
+    module_attendance = conn.execute("""
+        SELECT sm.module_code, sm.days_present,
+               ms.session_days as total_days,
+               ROUND(sm.days_present * 100.0 / ms.session_days, 2) as attendance_rate
+        FROM student_module_attendance sm
+        JOIN module_attendance_summary ms ON ms.module_code = sm.module_code
+        WHERE sm.student_id = ?
+        ORDER BY sm.module_code
+    """, (student['student_id'],)).fetchall()
+    
+    
+    return render_template("view_student.html", student=student, module_attendance=module_attendance, modules=get_modules(conn))
 
 # UPDATE - Edit Student
 @app.route("/edit_student/<int:student_id>", methods=["GET", "POST"])
@@ -372,47 +3147,65 @@ def edit_student(student_id):
         
         update_data = [name, mobile]
         update_query = "UPDATE students SET name = ?, mobile = ?"
+        student_data = conn.execute("SELECT student_id, photo_path FROM students WHERE id = ?", (student_id,)).fetchone()
+        templates = None
+        stale_photos = []
         
-        # Handle photo update
-        if photo and photo.filename:
-            # Delete old photo
-            old_student = conn.execute("SELECT photo_path FROM students WHERE id = ?", (student_id,)).fetchone()
-            if old_student and os.path.exists(old_student['photo_path']):
-                os.remove(old_student['photo_path'])
-            
-            # Save new photo
-            student_data = conn.execute("SELECT student_id FROM students WHERE id = ?", (student_id,)).fetchone()
-            filename = f"{student_data['student_id']}_{uuid.uuid4().hex[:8]}.jpg"
-            photo_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            photo.save(photo_path)
-            
-            # Extract features from new photo
-            features = extract_face_features(photo_path)
+        # Handle photo update: replace every enrolment template, or add
+        # this photo as one more template when add_template is ticked
+        if photo and photo.filename and student_data:
+            # Extract features from the new photo in memory first
+            photo_bytes = photo.read()
+            extracted, error = run_image_job(timed_extract, photo_bytes, "edit_student")
+            features, report = extracted or (None, None)
+            if report and report.reason:
+                error = f"{photo.filename}: {report.message}"
             if features is not None:
-                update_query += ', photo_path = ?, face_encoding = ?'
-                update_data.extend([photo_path, pickle.dumps(features)])
+                # Save new photo
+                filename = f"{student_data['student_id']}_{uuid.uuid4().hex[:8]}.jpg"
+                photo_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                with open(photo_path, "wb") as f:
+                    f.write(photo_bytes)
+                
+                replace = not request.form.get("add_template")
+                templates, stale_photos = store_face_templates(
+                    conn, student_data['student_id'], [(features, photo_path)], replace=replace)
+                update_query += ', face_encoding = ?'
+                update_data.append(encode_template(template_centroid(templates)[0]))
+                if replace:
+                    update_query += ', photo_path = ?'
+                    update_data.append(photo_path)
+                    stale_photos.append(student_data['photo_path'])
+                    queue_thumbnails(photo_path)
             else:
-                flash("Error processing new image. Photo not updated.", "warning")
+                flash(error or "Error processing new image. Photo not updated.", "warning")
         
         update_query += ' WHERE id = ?'
         update_data.append(student_id)
         
         conn.execute(update_query, tuple(update_data))
         conn.commit()
-        conn.close()
+        if student_data:
+            face_cache.upsert(conn, student_data['student_id'], name, templates)
+            aggregate_cache.invalidate(student=student_data['student_id'])
+        
+        # Delete replaced photos and their thumbnails only once the new
+        # templates are committed
+        remove_photo_files(stale_photos)
         
         flash('Student updated successfully!', 'success')
         return redirect('/view_students')
     
     # GET request - show edit form
     student = conn.execute("SELECT * FROM students WHERE id = ?", (student_id,)).fetchone()
-    conn.close()
     
     if student is None:
         flash("Student not found!", "danger")
         return redirect("/view_students")
     
-    return render_template("edit_student.html", student=student)
+    template_count = conn.execute("SELECT COUNT(*) FROM face_templates WHERE student_id = ?",
+                                  (student['student_id'],)).fetchone()[0]
+    return render_template("edit_student.html", student=student, template_count=template_count)
 
 # DELETE - Remove Student
 @app.route("/delete_student/<int:student_id>")
@@ -421,17 +3214,20 @@ def delete_student(student_id):
     conn = get_db_connection()
     
     # Get student data before deletion
-    student = conn.execute("SELECT photo_path FROM students WHERE id = ?", (student_id,)).fetchone()
+    student = conn.execute("SELECT student_id, photo_path FROM students WHERE id = ?", (student_id,)).fetchone()
     
     if student:
-        # Delete photo file
-        if student['photo_path'] and os.path.exists(student['photo_path']):
-            os.remove(student['photo_path'])
+        # Delete photo files (profile photo and every enrolment photo)
+        photo_paths = {student['photo_path']}
+        photo_paths.update(row[0] for row in conn.execute(
+            "SELECT photo_path FROM face_templates WHERE student_id = ?", (student['student_id'],)))
+        remove_photo_files(photo_paths)
         
-        # Delete from database
+        # Delete from database (a trigger drops the face_templates rows)
         conn.execute("DELETE FROM students WHERE id = ?", (student_id,))
         conn.commit()
-        conn.close()
+        face_cache.remove(conn, student['student_id'])
+        aggregate_cache.invalidate(student=student['student_id'])
         
         flash('Student deleted successfully!', 'success')
     else:
@@ -439,157 +3235,234 @@ def delete_student(student_id):
     
     return redirect('/view_students')
 
-# Lecturer attendance taking (with module selection)
-@app.route("/attendance", methods=["GET", "POST"])
+# Modules and their enrolment rosters
+@app.route("/modules", methods=["GET", "POST"])
 @lecturer_required
-def take_attendance():
+def manage_modules():
+    conn = get_db_connection()
+    
     if request.method == "POST":
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'live_attendance.jpg')
-        selected_module = request.form.get("module_code", "ALDS301")
+        module_code = request.form.get("module_code", "").strip().upper()
+        name = request.form.get("name", "").strip()
+        if not module_code.isalnum() or not name:
+            flash("A module needs an alphanumeric code and a name.", "danger")
+            return redirect("/modules")
+        conn.execute("""
+            INSERT INTO modules (module_code, name) VALUES (?, ?)
+            ON CONFLICT (module_code) DO UPDATE SET name = excluded.name
+        """, (module_code, name))
+        conn.commit()
+        flash(f"Module {module_code} saved.", "success")
+        return redirect("/modules")
+    
+    modules = conn.execute("""
+        SELECT m.module_code, m.name, COUNT(e.student_id) AS enrolled
+        FROM modules m
+        LEFT JOIN enrolments e ON e.module_code = m.module_code
+        GROUP BY m.module_code
+        ORDER BY m.module_code
+    """).fetchall()
+    return render_template("modules.html", modules=modules)
 
-        # --- Case 1: Camera Image (Base64) ---
-        if "camera_image" in request.form and request.form["camera_image"]:
-            try:
-                img_data = request.form["camera_image"].split(",")[1]  # remove "data:image/jpeg;base64,"
-                img_bytes = base64.b64decode(img_data)
+@app.route("/modules/<module_code>", methods=["GET", "POST"])
+@lecturer_required
+def module_roster(module_code):
+    conn = get_db_connection()
+    module = conn.execute("SELECT module_code, name FROM modules WHERE module_code = ?", (module_code,)).fetchone()
+    if module is None:
+        flash("Module not found!", "danger")
+        return redirect("/modules")
+    
+    if request.method == "POST":
+        student_ids = parse_student_ids(request.form.get("student_ids", ""))
+        roster = request.files.get("roster")
+        if roster and roster.filename:
+            student_ids += read_roster_ids(io.TextIOWrapper(roster.stream, encoding="utf-8-sig"))
+        replace = bool(request.form.get("replace"))
+        if not student_ids and not replace:
+            flash("Enter student IDs or upload a roster CSV.", "warning")
+            return redirect(f"/modules/{module_code}")
+        
+        added, removed, unknown = enrol_students(conn, module_code, student_ids, replace=replace)
+        conn.commit()
+        flash(f"{added} student(s) enrolled" + (f", {removed} removed" if removed else "") + ".", "success")
+        if unknown:
+            shown = ", ".join(unknown[:20]) + (f" and {len(unknown) - 20} more" if len(unknown) > 20 else "")
+            flash(f"Not registered, so not enrolled: {shown}", "warning")
+        return redirect(f"/modules/{module_code}")
+    
+    roster = conn.execute("""
+        SELECT s.id, s.student_id, s.name, e.enrolled_at
+        FROM enrolments e
+        JOIN students s ON s.student_id = e.student_id
+        WHERE e.module_code = ?
+        ORDER BY s.name COLLATE NOCASE
+    """, (module_code,)).fetchall()
+    return render_template("module_roster.html", module=module, roster=roster)
 
-                with open(temp_path, "wb") as f:
-                    f.write(img_bytes)
-            except Exception as e:
-                flash(f"Error decoding camera image: {e}", "danger")
-                return redirect("/attendance")
+@app.route("/modules/<module_code>/unenrol/<student_id>", methods=["POST"])
+@lecturer_required
+def unenrol_student(module_code, student_id):
+    conn = get_db_connection()
+    removed = conn.execute("DELETE FROM enrolments WHERE module_code = ? AND student_id = ?",
+                           (module_code, student_id)).rowcount
+    conn.commit()
+    if removed:
+        flash(f"{student_id} removed from {module_code}.", "success")
+    else:
+        flash("Student was not enrolled.", "warning")
+    return redirect(f"/modules/{module_code}")
+
+@metrics.route_scope("take_attendance")
+def record_room_attendance(img_bytes, module_code, now):
+    """Detect, match and record every face in a classroom photo.
+
+    Runs on the job queue; returns the flash message as a dict so a
+    polling client can show it too.
+    """
+    # --- Extract Features (one probe per detected face) ---
+    probes, report = timed_extract(img_bytes, "take_attendance", extract_all_face_features)
+    if report.reason:
+        return {"category": "warning", "message": report.message, "reason": report.reason}
+    if not probes:
+        return {"category": "danger", "message": "Error processing image. Please try again."}
 
-        # --- Case 2: Uploaded File ---
-        elif "photo" in request.files:
-            file = request.files["photo"]
-            if file.filename == "":
-                flash("No selected file", "danger")
-                return redirect("/attendance")
-            file.save(temp_path)
+    # --- Match every face in one batch against the module's roster ---
+    conn = get_db_connection()
+    matches = {}
+    with metrics.stage("take_attendance", "match"):
+        results = face_cache.match(conn, np.vstack(probes), module_code=module_code)
+    for result in results:
+        match = best_match(result)
+        if match and (match.student_id not in matches or match.score > matches[match.student_id].score):
+            matches[match.student_id] = match
 
+    # --- Record the whole room in one transaction ---
+    recognized_students = []
+    written = []
+    for match in sorted(matches.values(), key=lambda m: m.name):
+        # The unique (student, date, module) index rejects repeat check-ins
+        inserted = conn.execute("""
+            INSERT INTO attendance (student_id, date, time, module_code) 
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (student_id, date, module_code) DO NOTHING
+        """, (match.student_id, now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"), module_code)).rowcount
+        
+        if inserted:
+            recognized_students.append(f"{match.name} ({module_code})")
+            written.append(match.student_id)
         else:
-            flash("No photo or camera image provided", "danger")
-            return redirect("/attendance")
+            recognized_students.append(f"{match.name} (already marked for {module_code})")
 
-        # --- Extract Features ---
-        live_features = extract_face_features(temp_path)
-        if live_features is None:
-            flash("Error processing image. Please try again.", "danger")
-            os.remove(temp_path)
-            return redirect("/attendance")
+    conn.commit()
+    for student_id in written:
+        aggregate_cache.invalidate(now.strftime("%Y-%m-%d"), module_code, student_id)
 
-        # --- Compare with Database ---
-        conn = get_db_connection()
-        students = conn.execute("SELECT student_id, name, face_encoding FROM students").fetchall()
+    if recognized_students:
+        return {"category": "success", "message": f"Attendance recorded: {', '.join(recognized_students)}"}
+    return {"category": "warning", "message": "No matching students found"}
 
-        recognized_students = []
-        for student in students:
-            db_features = pickle.loads(student['face_encoding'])
-            if compare_faces(live_features, db_features):
-                now = datetime.now()
-                
-                # Check if already marked attendance for this module today
-                existing = conn.execute("""
-                    SELECT * FROM attendance 
-                    WHERE student_id=? AND date=? AND module_code=?
-                """, (student['student_id'], now.strftime("%Y-%m-%d"), selected_module)).fetchone()
-                
-                if existing:
-                    recognized_students.append(f"{student['name']} (already marked for {selected_module})")
-                else:
-                    conn.execute("""
-                        INSERT INTO attendance (student_id, date, time, module_code) 
-                        VALUES (?, ?, ?, ?)
-                    """, (student['student_id'], now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"), selected_module))
-                    recognized_students.append(f"{student['name']} ({selected_module})")
-                break
+# Lecturer attendance taking (with module selection)
+@app.route("/attendance", methods=["GET", "POST"])
+@lecturer_required
+def take_attendance():
+    if request.method == "POST":
+        selected_module = request.form.get("module_code", "ALDS301")
+        if selected_module not in get_modules(get_db_connection()):
+            flash("Unknown module.", "danger")
+            return redirect("/attendance")
 
-        conn.commit()
-        conn.close()
-        os.remove(temp_path)
+        # --- Camera image (base64) or uploaded file, kept in memory ---
+        img_bytes, error = read_submitted_image()
+        if error:
+            flash(error, "danger")
+            return redirect("/attendance")
 
-        if recognized_students:
-            flash(f"Attendance recorded: {', '.join(recognized_students)}", "success")
-        else:
-            flash("No matching students found", "warning")
+        # --- Detect, match and record on the job queue ---
+        try:
+            job = jobs.submit(record_room_attendance, img_bytes, selected_module, datetime.now(),
+                              owner=session["lecturer"])
+        except QueueFull:
+            flash("The server is busy processing other photos. Please try again in a moment.", "warning")
+            return redirect("/attendance")
+        try:
+            outcome = jobs.wait(job)
+        except FutureTimeout:
+            # Still running: the page polls /jobs/<id> for the outcome, and
+            # the poll may reach another worker, which only sees job_results
+            jobs.detach(job)
+            flash("Still processing the photo; the result will appear here shortly.", "info")
+            return redirect(f"/attendance?job={job.id}")
 
+        flash(outcome["message"], outcome["category"])
         return redirect("/attendance")
 
-    return render_template("attendance.html", modules=MODULES)
+    return render_template("attendance.html", modules=get_modules(get_db_connection()), job_id=request.args.get("job"))
 
 # Student attendance marking (with module selection)
 @app.route("/mark_attendance", methods=["GET", "POST"])
 @student_required
+@metrics.route_scope("mark_attendance")
 def mark_attendance():
     if request.method == "POST":
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'live_attendance.jpg')
         selected_module = request.form.get("module_code", "ALDS301")
+        conn = get_db_connection()
+        modules = get_modules(conn)
+        if selected_module not in modules:
+            flash("Unknown module.", "danger")
+            return redirect("/mark_attendance")
+        if not may_attend(conn, session["student"], selected_module):
+            flash(f"You are not enrolled in {modules[selected_module]}.", "danger")
+            return redirect("/mark_attendance")
 
-        # Handle camera image
-        if "camera_image" in request.form and request.form["camera_image"]:
-            try:
-                img_data = request.form["camera_image"].split(",")[1]
-                img_bytes = base64.b64decode(img_data)
-
-                with open(temp_path, "wb") as f:
-                    f.write(img_bytes)
-            except Exception as e:
-                flash(f"Error decoding camera image: {e}", "danger")
-                return redirect("/mark_attendance")
-
-        # Handle uploaded file
-        elif "photo" in request.files:
-            file = request.files["photo"]
-            if file.filename == "":
-                flash("No selected file", "danger")
-                return redirect("/mark_attendance")
-            file.save(temp_path)
-
-        else:
-            flash("No photo or camera image provided", "danger")
+        # Camera image or uploaded file, kept in memory
+        img_bytes, error = read_submitted_image()
+        if error:
+            flash(error, "danger")
             return redirect("/mark_attendance")
 
-        # Extract features
-        live_features = extract_face_features(temp_path)
+        # Extract features on the job queue
+        extracted, error = run_image_job(timed_extract, img_bytes, "mark_attendance")
+        if error:
+            flash(error, "warning")
+            return redirect("/mark_attendance")
+        live_features, report = extracted
+        if report.reason:
+            flash(report.message, "warning")
+            return redirect("/mark_attendance")
         if live_features is None:
             flash("Error processing image. Please try again.", "danger")
-            os.remove(temp_path)
             return redirect("/mark_attendance")
 
         # Compare with database
-        conn = get_db_connection()
-        student = conn.execute("SELECT face_encoding FROM students WHERE student_id=?", (session["student"],)).fetchone()
+        with metrics.stage("mark_attendance", "match"):
+            result = face_cache.match(conn, live_features, k=1, student_ids=[session["student"]])[0]
 
-        if student:
-            db_features = pickle.loads(student['face_encoding'])
-            if compare_faces(live_features, db_features):
+        if result.candidates:
+            if best_match(result):
                 now = datetime.now()
                 
-                # Check if already marked attendance for this module today
-                existing = conn.execute("""
-                    SELECT * FROM attendance 
-                    WHERE student_id=? AND date=? AND module_code=?
-                """, (session["student"], now.strftime("%Y-%m-%d"), selected_module)).fetchone()
+                # The unique (student, date, module) index rejects repeat check-ins
+                inserted = conn.execute("""
+                    INSERT INTO attendance (student_id, date, time, module_code) 
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (student_id, date, module_code) DO NOTHING
+                """, (session["student"], now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"), selected_module)).rowcount
+                conn.commit()
                 
-                if existing:
-                    flash(f"Attendance already marked for {selected_module} today!", "warning")
+                if inserted:
+                    aggregate_cache.invalidate(now.strftime("%Y-%m-%d"), selected_module, session["student"])
+                    flash(f"Attendance marked successfully for {modules[selected_module]}!", "success")
                 else:
-                    conn.execute("""
-                        INSERT INTO attendance (student_id, date, time, module_code) 
-                        VALUES (?, ?, ?, ?)
-                    """, (session["student"], now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"), selected_module))
-                    conn.commit()
-                    flash(f"Attendance marked successfully for {MODULES[selected_module]}!", "success")
+                    flash(f"Attendance already marked for {selected_module} today!", "warning")
             else:
                 flash("Face recognition failed. Please try again.", "danger")
         else:
             flash("Student record not found.", "danger")
 
-        conn.close()
-        os.remove(temp_path)
         return redirect("/mark_attendance")
 
-    return render_template("mark_attendance.html", modules=MODULES)
+    return render_template("mark_attendance.html", modules=get_modules(get_db_connection()))
 
 @app.route("/view_attendance")
 @lecturer_required
@@ -616,13 +3489,12 @@ def view_attendance():
     
     attendance_records = conn.execute(query, tuple(params)).fetchall()
     
-    conn.close()
     
     return render_template("view_attendance.html", 
                            attendance_records=attendance_records,
                            selected_date=date_filter,
                            selected_module=module_filter,
-                           modules=MODULES)
+                           modules=get_modules(conn))
 
 @app.route("/view_report")
 @lecturer_required
@@ -654,36 +3526,51 @@ def view_report():
     attendance_rate = round((present_today / total_students * 100), 2) if total_students > 0 else 0
 
     # module-wise attendance summary
-    module_summary = conn.execute(f"""
-        SELECT module_code, COUNT(DISTINCT student_id) as present_count,
-               (SELECT COUNT(*) FROM students) as total_students,
-               ROUND(COUNT(DISTINCT student_id) * 100.0 / (SELECT COUNT(*) FROM students), 2) as attendance_rate
-        FROM attendance 
+    module_summary = conn.execute("""
+        SELECT module_code, present_count,
+               ? as total_students,
+               ROUND(present_count * 100.0 / NULLIF(?, 0), 2) as attendance_rate
+        FROM daily_module_attendance 
         WHERE date = ?
-        GROUP BY module_code
-    """, (today,)).fetchall()
-
-    # student-wise report with module filtering
-    student_reports_query = f"""
-        SELECT s.student_id, s.name, 
-               COUNT(CASE WHEN {base_where} THEN 1 END) as days_present,
-               (SELECT COUNT(DISTINCT date) FROM attendance WHERE {base_where.replace('a.', '')}) as total_days
-        FROM students s
-        LEFT JOIN attendance a ON s.student_id = a.student_id
-        GROUP BY s.student_id, s.name
-        ORDER BY s.name
-    """
-    
-    raw_reports = conn.execute(student_reports_query, params).fetchall()
+        ORDER BY module_code
+    """, (total_students, total_students, today)).fetchall()
+
+    # student-wise report with module filtering, read from the rollup tables
+    if date_filter:
+        # A single day: the date index answers this directly
+        present = dict(conn.execute(f"""
+            SELECT a.student_id, COUNT(*) FROM attendance a
+            WHERE {base_where}
+            GROUP BY a.student_id
+        """, params).fetchall())
+        day_query = "SELECT COUNT(*) FROM daily_module_attendance WHERE date = ?"
+        day_params = [date_filter]
+        if module_filter:
+            day_query += " AND module_code = ?"
+            day_params.append(module_filter)
+        total_days = 1 if conn.execute(day_query, day_params).fetchone()[0] else 0
+    elif module_filter:
+        present = dict(conn.execute("""
+            SELECT student_id, days_present FROM student_module_attendance WHERE module_code = ?
+        """, (module_filter,)).fetchall())
+        row = conn.execute("SELECT session_days FROM module_attendance_summary WHERE module_code = ?",
+                           (module_filter,)).fetchone()
+        total_days = row[0] if row else 0
+    else:
+        present = dict(conn.execute("""
+            SELECT student_id, SUM(days_present) FROM student_module_attendance GROUP BY student_id
+        """).fetchall())
+        total_days = conn.execute("SELECT COUNT(DISTINCT date) FROM daily_module_attendance").fetchone()[0]
+
+    raw_reports = conn.execute("SELECT student_id, name FROM students ORDER BY name").fetchall()
 
     student_reports = []
-    for report in raw_reports:
-        student_id, name, days_present, total_days = report
+    for student_id, name in raw_reports:
+        days_present = present.get(student_id, 0)
         total_absent = (total_days - days_present) if total_days > 0 else 0
         attendance_pct = round((days_present / total_days * 100), 2) if total_days > 0 else 0
         student_reports.append((student_id, name, days_present, total_absent, attendance_pct))
 
-    conn.close()
 
     return render_template("view_report.html",
                            total_students=total_students,
@@ -692,11 +3579,732 @@ def view_report():
                            attendance_rate=attendance_rate,
                            student_reports=student_reports,
                            module_summary=module_summary,
-                           modules=MODULES,
+                           modules=get_modules(conn),
                            selected_module=module_filter,
                            selected_date=date_filter,
                            current_date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
+# ---------- PHOTO THUMBNAILS ----------
+# Derivatives are named after the uploaded photo (<stem>-<size>.<ext>), and
+# uploads always get a fresh name, so a thumbnail URL never changes content
+# and browsers may cache it for good.
+THUMBNAIL_FORMATS = {"webp": ("image/webp", "IMWRITE_WEBP_QUALITY", 80),
+                     "jpg": ("image/jpeg", "IMWRITE_JPEG_QUALITY", 85)}
+
+def photo_filename(photo_path):
+    """Bare file name of a stored photo path (older rows may use Windows separators)"""
+    return photo_path.replace("\\", "/").rsplit("/", 1)[-1]
+
+def stored_photo_path(photo_path):
+    """Where a students.photo_path lives on this machine, or None if unset"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], photo_filename(photo_path)) if photo_path else None
+
+def thumbnail_path(photo_path, size, fmt):
+    stem = os.path.splitext(photo_filename(photo_path))[0]
+    return os.path.join(app.config['THUMBNAIL_DIR'], f"{stem}-{size}.{fmt}")
+
+def make_thumbnail(photo_path, size, fmt):
+    """Write one centre-cropped square thumbnail of a photo; returns its path or None"""
+    side = app.config['THUMBNAIL_SIZES'][size]
+    with open(photo_path, "rb") as f:
+        data = f.read()
+
+    # Decode large JPEGs at a reduced scale that still covers the thumbnail
+    flag = cv2.IMREAD_COLOR
+    dims = image_dimensions(data)
+    if dims:
+        for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                                (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if min(dims) // factor >= side:
+                flag = reduced
+                break
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        return None
+
+    h, w = img.shape[:2]
+    crop = min(h, w)
+    top, left = (h - crop) // 2, (w - crop) // 2
+    img = img[top:top + crop, left:left + crop]
+    if crop > side:
+        img = cv2.resize(img, (side, side), interpolation=cv2.INTER_AREA)
+    _, quality_flag, quality = THUMBNAIL_FORMATS[fmt]
+    ok, encoded = cv2.imencode("." + fmt, img, [getattr(cv2, quality_flag), quality])
+    if not ok:
+        return None
+
+    # Write under a temporary name so a concurrent request never reads half a file
+    path = thumbnail_path(photo_path, size, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(encoded.tobytes())
+    os.replace(tmp, path)
+    return path
+
+def make_thumbnails(photo_path):
+    """Every size and format of a photo's thumbnails"""
+    for size in app.config['THUMBNAIL_SIZES']:
+        for fmt in THUMBNAIL_FORMATS:
+            make_thumbnail(photo_path, size, fmt)
+
+def queue_thumbnails(photo_path):
+    """Generate a new photo's thumbnails in the background.
+
+    Best effort, on its own queue so a bulk enrolment never takes capacity
+    from check-ins: when that queue is full the thumbnails are simply made
+    on first request instead.
+    """
+    try:
+        thumbnail_jobs.submit(make_thumbnails, photo_path)
+    except QueueFull:
+        pass
+
+def remove_photo_files(paths):
+    """Delete uploaded photos together with their thumbnails"""
+    for path in set(paths):
+        if not path:
+            continue
+        derived = [thumbnail_path(path, size, fmt)
+                   for size in app.config['THUMBNAIL_SIZES'] for fmt in THUMBNAIL_FORMATS]
+        for file_path in [path] + derived:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+@app.route("/photos/<size>/<filename>")
+@lecturer_required
+def photo_thumbnail(size, filename):
+    """A student photo thumbnail, WebP where the browser accepts it, else JPEG.
+
+    Made on first request if it is not on disk yet. Responses carry an ETag
+    and a year-long private Cache-Control, so a class list costs a few
+    kilobytes per student once and nothing on later visits.
+    """
+    filename = photo_filename(filename)
+    photo_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if size not in app.config['THUMBNAIL_SIZES'] or filename.startswith(".") or not os.path.isfile(photo_path):
+        return jsonify(error="Unknown photo"), 404
+
+    fmt = "webp" if request.accept_mimetypes["image/webp"] else "jpg"
+    path = thumbnail_path(photo_path, size, fmt)
+    if not os.path.exists(path) and make_thumbnail(photo_path, size, fmt) is None:
+        return jsonify(error="Photo could not be read"), 404
+
+    response = send_file(os.path.abspath(path), mimetype=THUMBNAIL_FORMATS[fmt][0],
+                         conditional=True, etag=True, max_age=app.config['THUMBNAIL_MAX_AGE'])
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    response.vary.add("Accept")
+    return response
+
+# ---------- JOB STATUS ----------
+@app.route("/jobs/<job_id>")
+@lecturer_required
+def job_status(job_id):
+    """Poll a queued job; the result is included once it is done, progress before that"""
+    outcome = job_outcome(job_id, session["lecturer"])
+    if outcome is None:
+        return jsonify(error="Unknown or expired job"), 404
+    status, data = outcome
+    if status == "done":
+        return jsonify(status=status, result=data)
+    if data is not None:
+        return jsonify(status=status, progress=data)
+    return jsonify(status=status)
+
+@app.route("/jobs/stats")
+@lecturer_required
+def job_stats():
+    """Queue depth, rejections and wait times, for sizing JOB_WORKERS"""
+    return jsonify(jobs.stats())
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape target: lecturers, or a scraper sending METRICS_TOKEN as a bearer token"""
+    token = app.config['METRICS_TOKEN']
+    scheme, _, supplied = request.headers.get("Authorization", "").partition(" ")
+    authorised = token and scheme == "Bearer" and secrets.compare_digest(supplied.encode(), token.encode())
+    if "lecturer" not in session and not authorised:
+        return Response("Lecturer login or metrics token required\n", status=403, mimetype="text/plain")
+
+    job_stats = jobs.stats()
+    cache_stats = aggregate_cache.stats()
+    live_streams = get_db_connection().execute(
+        "SELECT COUNT(*) FROM stream_sessions WHERE last_seen >= ?",
+        (time.time() - app.config['STREAM_IDLE_TIMEOUT'],)).fetchone()[0]
+    gauges = [
+        ("face_templates_cached", "Students in the in-memory template cache.", face_cache.size),
+        ("jobs_queued", "Image jobs waiting for a worker.", job_stats["queued"]),
+        ("jobs_running", "Image jobs being processed.", job_stats["running"]),
+        ("aggregate_cache_entries", "Entries in the dashboard aggregate cache.", cache_stats["entries"]),
+        ("live_stream_sessions", "Open live roll-call sessions.", live_streams),
+    ]
+    totals = [
+        ("jobs_rejected_total", "Image jobs turned away because the queue was full.", job_stats["rejected"]),
+        ("jobs_timed_out_total", "Requests that stopped waiting for their image job.", job_stats["timed_out"]),
+        ("aggregate_cache_hits_total", "Aggregate cache hits.", cache_stats["hits"]),
+        ("aggregate_cache_misses_total", "Aggregate cache misses.", cache_stats["misses"]),
+    ]
+    return Response(metrics.render(gauges, totals), mimetype="text/plain; version=0.0.4")
+
+@app.route("/metrics/profiles")
+@lecturer_required
+def list_profiles():
+    """Recent ?profile=1 captures, newest first"""
+    return jsonify([{"id": pid, "path": path, "ms": round(seconds * 1000, 1), "samples": samples}
+                    for pid, path, seconds, samples, _ in reversed(profiles)])
+
+@app.route("/metrics/profiles/<profile_id>")
+@lecturer_required
+def show_profile(profile_id):
+    """Collapsed stacks of one profiled request (feed to flamegraph.pl or speedscope)"""
+    for pid, _, _, _, stacks in profiles:
+        if pid == profile_id:
+            return Response(stacks + "\n", mimetype="text/plain")
+    return jsonify(error="Unknown profile"), 404
+
+@app.route("/cache/stats")
+@lecturer_required
+def cache_stats():
+    """Hit/miss counters of the dashboard aggregate cache"""
+    return jsonify(aggregate_cache.stats())
+
+# ---------- KIOSK API ----------
+def record_checkins(results, pending):
+    """Detect, match and record a kiosk batch; runs on the job queue.
+
+    pending holds (index, module_code, captured_at, img_bytes) for every
+    capture that passed validation; results[index] is updated in place
+    and the whole list returned.
+    """
+    probes, owners, captured = [], [], {}
+    for i, module_code, captured_at, img_bytes in pending:
+        result = results[i]
+        # One bad capture must not fail the rest of the batch
+        try:
+            faces, report = timed_extract(img_bytes, "sync_checkins", extract_all_face_features)
+        except Exception as e:
+            print(f"Error processing capture {result['id']!r}: {e}")
+            result["reason"] = "could not process image"
+            continue
+        if report.reason:
+            result["reason"] = report.message
+            result["quality"] = report.reason
+            continue
+        if not faces:
+            result["reason"] = "could not process image"
+            continue
+        probes.extend(faces)
+        owners.extend([i] * len(faces))
+        captured[i] = (module_code, captured_at)
+        result["status"] = "no_match"
+    
+    # --- One vectorised pass per module over its faces in the batch ---
+    conn = get_db_connection()
+    best = {}
+    by_module = {}
+    for p, owner in enumerate(owners):
+        by_module.setdefault(captured[owner][0], []).append(p)
+    for module_code, positions in by_module.items():
+        module_results = face_cache.match(conn, np.vstack([probes[p] for p in positions]), module_code=module_code)
+        for p, match_result in zip(positions, module_results):
+            owner = owners[p]
+            match = best_match(match_result)
+            if match and (owner not in best or match.score > best[owner].score):
+                best[owner] = match
+    
+    # --- One idempotent transaction for the whole batch ---
+    for i in sorted(best):
+        match = best[i]
+        module_code, captured_at = captured[i]
+        inserted = conn.execute("""
+            INSERT INTO attendance (student_id, date, time, module_code) 
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (student_id, date, module_code) DO NOTHING
+        """, (match.student_id, captured_at.strftime("%Y-%m-%d"), captured_at.strftime("%H:%M:%S"), module_code)).rowcount
+        results[i].update(status="marked" if inserted else "already_marked",
+                          student_id=match.student_id, name=match.name, score=round(match.score, 4))
+    conn.commit()
+    for i in sorted(best):
+        if results[i]["status"] == "marked":
+            aggregate_cache.invalidate(captured[i][1].strftime("%Y-%m-%d"), captured[i][0], best[i].student_id)
+    return results
+
+@app.route("/api/checkins", methods=["POST"])
+@kiosk_or_lecturer_required
+def sync_checkins():
+    """Batch upload of check-ins captured (possibly offline) by a kiosk.
+
+    Body: {"captures": [{"id", "module_code", "captured_at", "image"}, ...]}
+    where captured_at is ISO 8601 local time and image is base64. Faces are
+    matched in one vectorised pass per module, against that module's
+    roster, and inserted in one transaction;
+    re-sending a batch is harmless because repeats come back as
+    "already_marked". Returns one result per capture, in order; captures
+    the quality gate turns away carry a "quality" code (e.g. "too_dark").
+    The image work runs on the job queue: a full queue, or a batch that
+    outlasts JOB_TIMEOUT, is answered 503 with a Retry-After header.
+    """
+    payload = request.get_json(silent=True) or {}
+    captures = payload.get("captures")
+    if not isinstance(captures, list):
+        return jsonify(error='Expected a JSON body with a "captures" list'), 400
+    if len(captures) > app.config['CHECKIN_BATCH_LIMIT']:
+        return jsonify(error=f"At most {app.config['CHECKIN_BATCH_LIMIT']} captures per batch"), 413
+    
+    modules = get_modules(get_db_connection())
+    results, pending = [], []
+    latest_allowed = datetime.now() + timedelta(minutes=5)
+    for i, capture in enumerate(captures):
+        capture = capture if isinstance(capture, dict) else {}
+        result = {"id": capture.get("id"), "status": "invalid"}
+        results.append(result)
+        
+        module_code = capture.get("module_code")
+        if module_code not in modules:
+            result["reason"] = "unknown module_code"
+            continue
+        try:
+            captured_at = datetime.fromisoformat(str(capture.get("captured_at")))
+            if captured_at.tzinfo is not None:
+                captured_at = captured_at.astimezone().replace(tzinfo=None)
+        except (ValueError, OverflowError, OSError):
+            result["reason"] = "captured_at must be an ISO 8601 timestamp"
+            continue
+        if captured_at > latest_allowed:
+            result["reason"] = "captured_at is in the future"
+            continue
+        try:
+            img_bytes = decode_base64_image(str(capture.get("image", "")))
+        except ValueError:
+            result["reason"] = "image is not valid base64"
+            continue
+        pending.append((i, module_code, captured_at, img_bytes))
+    
+    if not pending:
+        return jsonify(results=results)
+    
+    # --- Detect, match and record on the job queue ---
+    retry_after = {"Retry-After": str(app.config['CHECKIN_RETRY_AFTER'])}
+    try:
+        job = jobs.submit(record_checkins, results, pending)
+    except QueueFull:
+        return jsonify(error="The server is busy processing other photos"), 503, retry_after
+    try:
+        results = jobs.wait(job)
+    except FutureTimeout:
+        # The job still finishes and records the batch; the resend comes
+        # back as "already_marked"
+        return jsonify(error="Processing the batch took too long"), 503, retry_after
+    return jsonify(results=results)
+
+# ---------- LIVE STREAM ATTENDANCE ----------
+def frame_hash(gray):
+    """64-bit difference hash (dHash) of a grayscale frame"""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    return int(np.packbits(small[:, 1:] > small[:, :-1]).view(">u8")[0])
+
+STREAM_STATS = ("received", "analysed", "throttled", "unchanged", "poor_quality", "busy", "faces")
+
+class StreamSession:
+    """One lecturer's live roll call for a module.
+
+    Frames are analysed best-effort. A frame is skipped when it arrives
+    before the current interval has elapsed, when its dHash is within
+    STREAM_HASH_DISTANCE bits of the last analysed frame, or when every
+    stream worker slot is busy. The interval speeds up while new students
+    are being recognised and backs off while the scene is empty or static,
+    so a quiet room costs almost nothing. Each student is matched and
+    written at most once per session; the unique attendance index keeps
+    it to once per module per day across sessions.
+
+    The session itself is a stream_sessions row, so its frames may land on
+    any worker. Each worker keeps its own StreamSession for the rate and
+    frame hash, loaded from that row on first use. Who was marked goes to
+    stream_marks, and a worker's counters are added to the row whenever
+    one of its frames gets past the rate limit, so the database is touched
+    at the analysed rate rather than the camera's frame rate.
+    """
+
+    def __init__(self, stream_id, lecturer, module_code):
+        self.id = stream_id
+        self.lecturer = lecturer
+        self.module_code = module_code
+        self.lock = threading.Lock()
+        self.interval_ms = app.config['STREAM_MIN_INTERVAL_MS']
+        self.last_hash = None
+        self.last_analysed = 0.0
+        self.last_seen = time.monotonic()
+        self.marked = {}         # student_id -> name, already recorded for this session
+        self.total_marked = 0    # across every worker, as of the last sync
+        self.pending = dict.fromkeys(STREAM_STATS, 0)   # counts not yet added to the row
+
+    @classmethod
+    def create(cls, conn, lecturer, module_code):
+        stream = cls(uuid.uuid4().hex, lecturer, module_code)
+        conn.execute("INSERT INTO stream_sessions (id, lecturer, module_code, last_seen) VALUES (?, ?, ?, ?)",
+                     (stream.id, lecturer, module_code, time.time()))
+        conn.commit()
+        return stream
+
+    @classmethod
+    def load(cls, conn, stream_id):
+        """Session opened on any worker and not yet closed or expired, or None"""
+        row = conn.execute("SELECT lecturer, module_code FROM stream_sessions WHERE id = ? AND last_seen >= ?",
+                           (stream_id, time.time() - app.config['STREAM_IDLE_TIMEOUT'])).fetchone()
+        return cls(stream_id, row['lecturer'], row['module_code']) if row else None
+
+    def _sync(self, conn):
+        """Add this worker's pending counts to the session row; False once the session is gone"""
+        now = time.time()
+        counters = ", ".join(f"{name} = {name} + ?" for name in STREAM_STATS)
+        alive = conn.execute(f"""
+            UPDATE stream_sessions SET last_seen = ?, {counters}
+            WHERE id = ? AND last_seen >= ?
+        """, (now, *(self.pending[name] for name in STREAM_STATS),
+              self.id, now - app.config['STREAM_IDLE_TIMEOUT'])).rowcount
+        conn.commit()
+        if alive:
+            self.pending = dict.fromkeys(STREAM_STATS, 0)
+            self.total_marked = conn.execute("SELECT COUNT(*) FROM stream_marks WHERE stream_id = ?",
+                                             (self.id,)).fetchone()[0]
+        return bool(alive)
+
+    def _back_off(self):
+        self.interval_ms = min(int(self.interval_ms * 1.5), app.config['STREAM_MAX_INTERVAL_MS'])
+
+    def _result(self, status, marked=(), faces=0):
+        return {"status": status, "faces": faces, "marked": list(marked),
+                "total_marked": self.total_marked, "interval_ms": self.interval_ms}
+
+    def process(self, conn, data):
+        """Analyse one encoded frame if it is worth it.
+
+        Returns a JSON-able dict, or None when the session has been closed
+        or has expired.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.last_seen = now
+            self.pending["received"] += 1
+            if (now - self.last_analysed) * 1000 < self.interval_ms:
+                self.pending["throttled"] += 1
+                return self._result("throttled")
+            if not self._sync(conn):
+                return None
+
+            gray = decode_gray_image(data)
+            if gray is None:
+                return self._result("invalid")
+            # Compare against the last *analysed* frame so slow drift still adds up
+            digest = frame_hash(gray)
+            if self.last_hash is not None and (digest ^ self.last_hash).bit_count() <= app.config['STREAM_HASH_DISTANCE']:
+                self.pending["unchanged"] += 1
+                self._back_off()
+                return self._result("unchanged")
+
+            # A dark or blurred frame will not match anyone; skip it cheaply
+            report = assess_image_quality(gray)
+            if report.reason:
+                self.pending["poor_quality"] += 1
+                metrics.increment("image_quality_rejections_total", (("route", "stream"), ("reason", report.reason)))
+                self._back_off()
+                result = self._result("poor_quality")
+                result["reason"] = report.message
+                return result
+
+            if not _stream_slots.acquire(blocking=False):
+                self.pending["busy"] += 1
+                self._back_off()
+                return self._result("busy")
+            try:
+                self.last_hash = digest
+                self.last_analysed = now
+                probes = extract_all_face_features(gray, whole_frame_fallback=False)
+                marked = self._mark(conn, probes) if probes else []
+            finally:
+                _stream_slots.release()
+
+            self.pending["analysed"] += 1
+            self.pending["faces"] += len(probes)
+            if marked:
+                self.interval_ms = app.config['STREAM_MIN_INTERVAL_MS']
+            elif not probes:
+                self._back_off()
+            return self._result("analysed", marked, len(probes))
+
+    def _mark(self, conn, probes):
+        """Match the faces in one frame and record students not yet seen"""
+        now = datetime.now()
+        marked = []
+        for result in face_cache.match(conn, np.vstack(probes), module_code=self.module_code):
+            match = best_match(result)
+            if match is None or match.student_id in self.marked:
+                continue
+            self.marked[match.student_id] = match.name
+            # Another worker may have recorded them for this session already
+            if not conn.execute("INSERT OR IGNORE INTO stream_marks (stream_id, student_id, name) VALUES (?, ?, ?)",
+                                (self.id, match.student_id, match.name)).rowcount:
+                continue
+            inserted = conn.execute("""
+                INSERT INTO attendance (student_id, date, time, module_code) 
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (student_id, date, module_code) DO NOTHING
+            """, (match.student_id, now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"), self.module_code)).rowcount
+            marked.append({"student_id": match.student_id, "name": match.name,
+                           "status": "marked" if inserted else "already_marked"})
+        conn.commit()
+        self.total_marked += len(marked)
+        for student in marked:
+            if student["status"] == "marked":
+                aggregate_cache.invalidate(now.strftime("%Y-%m-%d"), self.module_code, student["student_id"])
+        return marked
+
+    def summary(self, conn):
+        """Counters and marked students of the whole session, from every worker"""
+        with self.lock:
+            self._sync(conn)
+            row = conn.execute(f"SELECT {', '.join(STREAM_STATS)} FROM stream_sessions WHERE id = ?",
+                               (self.id,)).fetchone()
+            stats = dict(zip(STREAM_STATS, row)) if row else dict(self.pending)
+            marked = [{"student_id": sid, "name": name} for sid, name in conn.execute(
+                "SELECT student_id, name FROM stream_marks WHERE stream_id = ? ORDER BY rowid", (self.id,))]
+        return {"stream_id": self.id, "module_code": self.module_code, "stats": stats, "marked": marked}
+
+_stream_sessions = {}    # this worker's StreamSessions, by id
+_stream_sessions_lock = threading.Lock()
+_stream_slots = threading.BoundedSemaphore(app.config['STREAM_MAX_WORKERS'])
+
+def get_stream_session(conn, stream_id):
+    """Live stream session owned by the logged-in lecturer, or None"""
+    with _stream_sessions_lock:
+        stream = _stream_sessions.get(stream_id)
+    if stream is None:
+        stream = StreamSession.load(conn, stream_id)
+        if stream is None:
+            return None
+        with _stream_sessions_lock:
+            stream = _stream_sessions.setdefault(stream_id, stream)
+    if stream.lecturer != session.get("lecturer"):
+        return None
+    return stream
+
+def forget_stream_session(stream_id):
+    with _stream_sessions_lock:
+        _stream_sessions.pop(stream_id, None)
+
+def iter_mjpeg_frames(stream, boundary):
+    """Yield frame bodies from a multipart/x-mixed-replace feed as they arrive.
+
+    Every part must carry a Content-Length header (ffmpeg's mpjpeg muxer and
+    most MJPEG encoders send one), so frames are read without scanning for
+    the boundary.
+    """
+    delimiter = b"--" + boundary.encode("latin-1")
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        line = line.strip()
+        if not line.startswith(delimiter):
+            continue
+        if line == delimiter + b"--":
+            return
+        headers = {}
+        while True:
+            header = stream.readline()
+            if not header.strip():
+                break
+            name, _, value = header.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = headers.get("content-length", "")
+        if not length.isdigit():
+            raise ValueError("Every frame needs a Content-Length header")
+        yield stream.read(int(length))
+
+@app.route("/attendance/stream", methods=["POST"])
+@lecturer_required
+def start_attendance_stream():
+    """Open a live roll-call session; frames then go to .../frame or .../feed"""
+    payload = request.get_json(silent=True) or request.form
+    conn = get_db_connection()
+    module_code = payload.get("module_code")
+    if module_code not in get_modules(conn):
+        return jsonify(error="Unknown module_code"), 400
+
+    # Sessions abandoned without a DELETE expire after STREAM_IDLE_TIMEOUT
+    conn.execute("DELETE FROM stream_marks WHERE stream_id IN (SELECT id FROM stream_sessions WHERE last_seen < ?)",
+                 (time.time() - app.config['STREAM_IDLE_TIMEOUT'],))
+    conn.execute("DELETE FROM stream_sessions WHERE last_seen < ?", (time.time() - app.config['STREAM_IDLE_TIMEOUT'],))
+    stream = StreamSession.create(conn, session["lecturer"], module_code)
+    cutoff = time.monotonic() - app.config['STREAM_IDLE_TIMEOUT']
+    with _stream_sessions_lock:
+        for stream_id in [k for k, s in _stream_sessions.items() if s.last_seen < cutoff]:
+            del _stream_sessions[stream_id]
+        _stream_sessions[stream.id] = stream
+    return jsonify(stream_id=stream.id, interval_ms=stream.interval_ms), 201
+
+@app.route("/attendance/stream/<stream_id>/frame", methods=["POST"])
+@lecturer_required
+def attendance_stream_frame(stream_id):
+    """One low-res JPEG/PNG frame as the raw request body"""
+    conn = get_db_connection()
+    stream = get_stream_session(conn, stream_id)
+    if stream is None:
+        return jsonify(error="Unknown or expired stream"), 404
+    data = request.get_data(cache=False)
+    if not data:
+        return jsonify(error="Expected an image as the request body"), 400
+    result = stream.process(conn, data)
+    if result is None:
+        forget_stream_session(stream_id)
+        return jsonify(error="Unknown or expired stream"), 404
+    return jsonify(result)
+
+@app.route("/attendance/stream/<stream_id>/feed", methods=["POST"])
+@lecturer_required
+def attendance_stream_feed(stream_id):
+    """Continuous multipart/x-mixed-replace (MJPEG) feed, e.g. chunked from ffmpeg.
+
+    Frames are analysed as they arrive, at the session's adaptive rate;
+    the response is the session summary once the feed ends.
+    """
+    conn = get_db_connection()
+    stream = get_stream_session(conn, stream_id)
+    if stream is None:
+        return jsonify(error="Unknown or expired stream"), 404
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/x-mixed-replace" or not boundary:
+        return jsonify(error="Expected multipart/x-mixed-replace with a boundary"), 415
+
+    try:
+        for frame in iter_mjpeg_frames(request.stream, boundary):
+            if stream.process(conn, frame) is None:
+                forget_stream_session(stream_id)
+                return jsonify(error="Stream closed while the feed was running"), 404
+    except ValueError as e:
+        return jsonify(error=str(e), **stream.summary(conn)), 400
+    return jsonify(stream.summary(conn))
+
+@app.route("/attendance/stream/<stream_id>", methods=["DELETE"])
+@lecturer_required
+def stop_attendance_stream(stream_id):
+    """Close a live session and return who was recognised"""
+    conn = get_db_connection()
+    stream = get_stream_session(conn, stream_id)
+    if stream is None:
+        return jsonify(error="Unknown or expired stream"), 404
+    summary = stream.summary(conn)
+    conn.execute("DELETE FROM stream_marks WHERE stream_id = ?", (stream_id,))
+    conn.execute("DELETE FROM stream_sessions WHERE id = ?", (stream_id,))
+    conn.commit()
+    forget_stream_session(stream_id)
+    return jsonify(summary)
+
+# ---------- EXPORTS ----------
+EXPORT_BATCH_SIZE = 500
+EXPORT_FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+def export_filters():
+    """WHERE clause and params from the date_from / date_to / module args"""
+    clauses, params = [], []
+    if request.args.get('date_from'):
+        clauses.append("a.date >= ?")
+        params.append(request.args['date_from'])
+    if request.args.get('date_to'):
+        clauses.append("a.date <= ?")
+        params.append(request.args['date_to'])
+    if request.args.get('module'):
+        clauses.append("a.module_code = ?")
+        params.append(request.args['module'])
+    return " AND ".join(clauses) or "1=1", params
+
+def stream_export(cursor, columns, fmt):
+    """Yield a CSV or JSON-lines document from a cursor, one batch at a time"""
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(columns)
+        yield buf.getvalue()
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            break
+        if fmt == "csv":
+            buf.seek(0)
+            buf.truncate(0)
+            writer.writerows(tuple(row) for row in rows)
+            yield buf.getvalue()
+        else:
+            yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+
+def export_response(cursor, columns, basename):
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        fmt = 'csv'
+    # The query args are user input: keep quotes, separators and CRLF out of the header
+    parts = [basename] + [secure_filename(request.args.get(arg, "")) for arg in ('module', 'date_from', 'date_to')]
+    filename = "_".join(p for p in parts if p) + "." + fmt
+    return Response(stream_with_context(stream_export(cursor, columns, fmt)),
+                    mimetype=EXPORT_FORMATS[fmt],
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+@app.route("/export/attendance")
+@lecturer_required
+def export_attendance():
+    """Stream attendance rows filtered by date range, module and student"""
+    where, params = export_filters()
+    if request.args.get('student'):
+        where += " AND a.student_id = ?"
+        params.append(request.args['student'])
+    
+    conn = get_db_connection()
+    cursor = conn.execute(f"""
+        SELECT a.student_id, s.name, a.date, a.time, a.module_code
+        FROM attendance a
+        LEFT JOIN students s ON a.student_id = s.student_id
+        WHERE {where}
+        ORDER BY a.date, a.time
+    """, params)
+    return export_response(cursor, ["student_id", "name", "date", "time", "module_code"], "attendance")
+
+@app.route("/export/report")
+@lecturer_required
+def export_report():
+    """Stream the per-student attendance report over a date range / module"""
+    where, params = export_filters()
+    student_where = "1=1"
+    if request.args.get('student'):
+        student_where = "s.student_id = ?"
+        params.append(request.args['student'])
+    
+    conn = get_db_connection()
+    cursor = conn.execute(f"""
+        WITH filtered AS (
+            SELECT a.student_id, a.date FROM attendance a WHERE {where}
+        ),
+        totals AS (
+            SELECT COUNT(DISTINCT date) AS total_days FROM filtered
+        ),
+        present AS (
+            SELECT student_id, COUNT(*) AS days_present FROM filtered GROUP BY student_id
+        )
+        SELECT s.student_id, s.name,
+               COALESCE(p.days_present, 0) AS days_present,
+               t.total_days,
+               CASE WHEN t.total_days > 0 THEN t.total_days - COALESCE(p.days_present, 0) ELSE 0 END AS days_absent,
+               CASE WHEN t.total_days > 0 THEN ROUND(COALESCE(p.days_present, 0) * 100.0 / t.total_days, 2) ELSE 0 END AS attendance_pct
+        FROM students s
+        CROSS JOIN totals t
+        LEFT JOIN present p ON p.student_id = s.student_id
+        WHERE {student_where}
+        ORDER BY s.name
+    """, params)
+    return export_response(cursor, ["student_id", "name", "days_present", "total_days", "days_absent", "attendance_pct"],
+                           "report")
+
 @app.route("/debug_routes")
 def debug_routes():
     routes = []
@@ -705,5 +4313,27 @@ def debug_routes():
             routes.append(str(rule))
     return "<br>".join(routes)
 
+# ---------- STARTUP ----------
+def warm_up():
+    """Load what the first check-in would otherwise wait for: OpenCV, the
+    face detector, the PCA projection and the template cache"""
+    with app.app_context():
+        get_face_detector()
+        get_projection()
+        face_cache.ensure_fresh(get_db_connection())
+
+def create_app():
+    """WSGI entry point, e.g. `gunicorn "app:create_app()"`.
+
+    Importing this module does no database work and leaves OpenCV and
+    numpy unloaded until a request needs them, so a new worker serves the
+    dashboard straight away. With VISION_WARM_UP the vision stack loads in
+    a background thread instead, ready for the first check-in.
+    """
+    if app.config['VISION_WARM_UP']:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    return app
+
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    init_db()
+    create_app().run(debug=True)
\ No newline at end of file
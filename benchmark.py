@@ -0,0 +1,382 @@
+"""Benchmark harness for the attendance system's hot paths.
+
+Generates a synthetic deployment per scale (students with face templates,
+months of attendance, a fitted PCA projection, synthetic face photos),
+times each hot path at that scale and writes the results as JSON:
+
+    python benchmark.py run --scales 1000,10000,100000 --out bench-main.json
+    python benchmark.py run --scales 1000 --out bench-mine.json
+    python benchmark.py compare bench-main.json bench-mine.json
+    python benchmark.py startup
+
+Every scale runs in its own subprocess and scratch directory, so the app
+initialises a fresh database and nothing touches attendance.db.
+`compare` exits non-zero when any p50 got slower than --threshold, which
+makes it usable as a regression gate. `startup` does the same for the
+import-time budget: importing app.py must stay under --budget-ms and must
+not pull in OpenCV or numpy.
+"""
+import base64
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import click
+import cv2
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULE_CODES = ["ALDS301", "SEP401", "DBS501", "NWC601"]
+IMPORT_BUDGET_MS = 100   # p50 cost of importing app.py on top of Flask itself
+
+# ---------- SYNTHETIC DATA ----------
+def synthetic_face(rng, size=(480, 640)):
+    """Face-like drawing (head, eyes, mouth) with sensor noise, as BGR"""
+    h, w = size
+    img = np.full((h, w, 3), rng.integers(60, 200, 3), dtype=np.uint8)
+    cx, cy = w // 2 + int(rng.integers(-w // 10, w // 10)), h // 2
+    ax, ay = int(w * rng.uniform(0.15, 0.22)), int(h * rng.uniform(0.3, 0.4))
+    cv2.ellipse(img, (cx, cy), (ax, ay), 0, 0, 360, tuple(int(c) for c in rng.integers(120, 230, 3)), -1)
+    for dx in (-1, 1):
+        cv2.circle(img, (cx + dx * ax // 2, cy - ay // 4), max(2, ax // 8), (40, 40, 40), -1)
+    cv2.ellipse(img, (cx, cy + ay // 2), (ax // 3, ay // 10), 0, 0, 180, (60, 40, 140), -1)
+    noise = rng.normal(0, 8, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+def synthetic_classroom(rng, rows=3, cols=6, face=(160, 120)):
+    """Grid of synthetic faces, like a lecture-hall photo"""
+    return np.vstack([np.hstack([synthetic_face(rng, face) for _ in range(cols)]) for _ in range(rows)])
+
+def jpeg(img, quality=90):
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+def populate(A, conn, students, checkins, days, rng):
+    """Fill the app's freshly initialised database with synthetic data"""
+    # PCA projection fitted on synthetic photos, so templates have the
+    # deployed dimensionality
+    raw = np.vstack([A.extract_face_features(jpeg(synthetic_face(rng)), project=False) for _ in range(300)])
+    A.FaceProjection.fit(raw, 128).save(A.app.config['PROJECTION_PATH'])
+    dim = A.get_projection().dim
+
+    templates = rng.standard_normal((students, dim)).astype(np.float32)
+    templates /= np.linalg.norm(templates, axis=1, keepdims=True)
+    ids = [f"B{i:07d}" for i in range(students)]
+    created = datetime(2024, 1, 1)
+    conn.executemany("""
+        INSERT INTO students (student_id, name, mobile, password, face_encoding, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, ((sid, f"Student {i}", "0000000000", "pw", A.encode_template(templates[i]),
+           (created + timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S")) for i, sid in enumerate(ids)))
+    conn.executemany("INSERT INTO face_templates (student_id, template) SELECT student_id, face_encoding "
+                     "FROM students WHERE student_id = ?", ((sid,) for sid in ids))
+
+    # Each student checks in to `checkins` distinct (day, module) slots.
+    # The rollup triggers are dropped for the load and the rollups rebuilt
+    # once, as a real import would.
+    conn.execute("DROP TRIGGER IF EXISTS attendance_rollups_insert")
+    conn.execute("DROP TRIGGER IF EXISTS attendance_rollups_delete")
+    first_day = date.today() - timedelta(days=days - 1)
+    dates = [(first_day + timedelta(days=d)).strftime("%Y-%m-%d") for d in range(days)]
+    slots = days * len(MODULE_CODES)
+    checkins = min(checkins, slots)
+    for start in range(0, students, 10000):
+        chunk = range(start, min(start + 10000, students))
+        picks = np.argpartition(rng.random((len(chunk), slots), dtype=np.float32), checkins - 1, axis=1)[:, :checkins]
+        minutes = rng.integers(8 * 60, 18 * 60, picks.shape)
+        conn.executemany(
+            "INSERT INTO attendance (student_id, date, time, module_code) VALUES (?, ?, ?, ?)",
+            ((ids[s], dates[slot // len(MODULE_CODES)], f"{m // 60:02d}:{m % 60:02d}:00",
+              MODULE_CODES[slot % len(MODULE_CODES)])
+             for s, row, mins in zip(chunk, picks.tolist(), minutes.tolist()) for slot, m in zip(row, mins)))
+    A._migration_attendance_rollups(conn)
+    conn.commit()
+    return templates, dates
+
+# ---------- MEASUREMENT ----------
+def measure(fn, budget, max_runs, min_runs=3, items=1):
+    """Run fn until the time budget or max_runs is spent; latency in ms"""
+    fn()   # warm-up
+    samples = []
+    deadline = time.perf_counter() + budget
+    while len(samples) < max_runs and (len(samples) < min_runs or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarise(np.array(samples) * 1000, items)
+
+def summarise(samples, items=1):
+    """Latency stats for an array of millisecond samples"""
+    return {"runs": len(samples), "items": items,
+            "p50_ms": round(float(np.percentile(samples, 50)), 4),
+            "p99_ms": round(float(np.percentile(samples, 99)), 4),
+            "mean_ms": round(float(samples.mean()), 4),
+            "throughput_per_s": round(items * len(samples) / (samples.sum() / 1000), 2)}
+
+# Runs in a fresh interpreter: argv[1] is the repository, the working
+# directory holds an initialised database
+STARTUP_PROBE = r"""
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import click, flask
+framework = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+client.post("/lecturer_login", data={"staff_id": "admin", "password": "1234"})
+client.get("/dashboard")
+done = time.perf_counter()
+print(json.dumps({"import_app": imported - framework, "first_dashboard": done - imported,
+                  "vision_loaded": [m for m in ("cv2", "numpy") if m in sys.modules]}))
+"""
+
+def measure_startup(runs, workdir=None):
+    """Cold-start latency in fresh processes: importing app.py (framework
+    imports excluded) and serving the first dashboard after it.
+
+    Returns (stats per step, modules among cv2/numpy that got loaded).
+    """
+    samples = {"import_app": [], "first_dashboard": []}
+    vision_loaded = set()
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", STARTUP_PROBE, REPO_DIR], cwd=workdir,
+                             capture_output=True, text=True, check=True).stdout
+        probe = json.loads(out.strip().splitlines()[-1])
+        for name in samples:
+            samples[name].append(probe[name] * 1000)
+        vision_loaded.update(probe["vision_loaded"])
+    return {name: summarise(np.array(values)) for name, values in samples.items()}, sorted(vision_loaded)
+
+def compare_faces(features1, features2, threshold=0.8):
+    """The original one-pair cosine check, kept as the per-student scan baseline"""
+    if features1 is None or features2 is None:
+        return False
+    norm1 = np.linalg.norm(features1)
+    norm2 = np.linalg.norm(features2)
+    if norm1 == 0 or norm2 == 0:
+        return False
+    return np.dot(features1, features2) / (norm1 * norm2) > threshold
+
+def ok(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.path} returned {response.status_code}")
+    return response
+
+def run_scale(students, checkins, days, budget, max_runs, seed):
+    """Build one synthetic deployment in the current directory and time it"""
+    sys.path.insert(0, REPO_DIR)
+    import app as A
+    A.init_db()
+
+    rng = np.random.default_rng(seed)
+    A.app.app_context().push()
+    conn = A.get_db_connection()
+    start = time.perf_counter()
+    templates, dates = populate(A, conn, students, checkins, days, rng)
+    setup_s = time.perf_counter() - start
+    attendance_rows = conn.execute("SELECT COUNT(*) FROM attendance").fetchone()[0]
+
+    vga = jpeg(synthetic_face(rng))
+    photo_12mp = jpeg(synthetic_face(rng, (3000, 4000)))
+    classroom = jpeg(synthetic_classroom(rng))
+    picked = rng.choice(students, 32)
+    probes = templates[picked] + 0.05 * rng.standard_normal((32, templates.shape[1])).astype(np.float32)
+    cache = A.face_cache
+    results = {}
+
+    def bench(name, fn, **kwargs):
+        results[name] = measure(fn, budget, kwargs.pop("max_runs", max_runs), **kwargs)
+        click.echo(f"  {students:>7} {name:<24} p50 {results[name]['p50_ms']:>10.3f} ms  "
+                   f"p99 {results[name]['p99_ms']:>10.3f} ms", err=True)
+
+    # --- Image pipeline (independent of scale, tracked for regressions) ---
+    bench("decode_vga", lambda: A.decode_gray_image(vga))
+    bench("decode_12mp", lambda: A.decode_gray_image(photo_12mp))
+    bench("extract_vga", lambda: A.extract_face_features(vga))
+    bench("extract_12mp", lambda: A.extract_face_features(photo_12mp))
+    bench("extract_all_classroom", lambda: A.extract_all_face_features(classroom))
+
+    # --- Matching ---
+    bench("cache_rebuild", lambda: cache.load(conn, from_store=False), max_runs=min(max_runs, 10))
+    cache.flush()   # the rebuild's snapshot is written in the background
+    bench("cache_load", lambda: cache.load(conn), max_runs=min(max_runs, 10))
+
+    def update_one():
+        # One committed edit applied in place (its snapshot is written in the background)
+        conn.execute("UPDATE students SET name = name WHERE student_id = 'B0000000'")
+        conn.commit()
+        cache.upsert(conn, "B0000000", "Student 0")
+    bench("cache_update", update_one, max_runs=min(max_runs, 20))
+    cache.flush()
+    cache.ensure_fresh(conn)
+    bench("compare_faces_scan", lambda: [compare_faces(probes[0], t) for t in templates],
+          max_runs=min(max_runs, 10), min_runs=1)
+    bench("match_exact", lambda: cache.match(conn, probes[0], exact=True))
+    bench("match_exact_batch32", lambda: cache.match(conn, probes, exact=True), items=32)
+    cache.build_ann(conn)
+    A.app.config['ANN_MIN_STUDENTS'] = 0
+    bench("match_ann", lambda: cache.match(conn, probes[0]))
+    bench("match_ann_batch32", lambda: cache.match(conn, probes), items=32)
+    # A lecture-sized roster (the probed students plus a few others)
+    roster = np.union1d(picked, rng.choice(students, 8, replace=False))
+    conn.executemany("INSERT OR IGNORE INTO enrolments (module_code, student_id) VALUES (?, ?)",
+                     ((MODULE_CODES[2], f"B{i:07d}") for i in roster.tolist()))
+    conn.commit()
+    bench("match_module", lambda: cache.match(conn, probes[0], module_code=MODULE_CODES[2]))
+    bench("match_module_batch32", lambda: cache.match(conn, probes, module_code=MODULE_CODES[2]), items=32)
+
+    # --- Routes, end to end through the test client ---
+    client = A.app.test_client()
+    ok(client.post("/lecturer_login", data={"staff_id": "admin", "password": "1234"}))
+    camera_image = "data:image/jpeg;base64," + base64.b64encode(classroom).decode()
+    bench("take_attendance", lambda: ok(client.post(
+        "/attendance", data={"module_code": MODULE_CODES[0], "camera_image": camera_image})))
+    bench("view_report", lambda: ok(client.get("/view_report")))
+    bench("view_report_module", lambda: ok(client.get(f"/view_report?module_filter={MODULE_CODES[1]}")))
+    bench("view_report_date", lambda: ok(client.get(f"/view_report?date_filter={dates[-1]}")))
+    bench("dashboard_cold", lambda: (A.aggregate_cache.invalidate(), ok(client.get("/dashboard"))))
+    bench("dashboard_warm", lambda: ok(client.get("/dashboard")))
+    bench("view_students", lambda: ok(client.get("/view_students")))
+    bench("view_students_search", lambda: ok(client.get("/view_students?q=Student 12")))
+
+    # --- Cold start of a fresh worker against this database ---
+    startup, _ = measure_startup(min(max_runs, 10))
+    for name, stats in startup.items():
+        results[name] = stats
+        click.echo(f"  {students:>7} {name:<24} p50 {stats['p50_ms']:>10.3f} ms  "
+                   f"p99 {stats['p99_ms']:>10.3f} ms", err=True)
+
+    return {"students": students, "attendance_rows": attendance_rows, "template_dim": int(templates.shape[1]),
+            "setup_s": round(setup_s, 2), "benchmarks": results}
+
+# ---------- CLI ----------
+@click.group()
+def cli():
+    """Benchmark the attendance system's hot paths on synthetic data"""
+
+@cli.command()
+@click.option("--scales", default="1000,10000,100000", show_default=True, help="Comma-separated student counts.")
+@click.option("--checkins", type=int, default=30, show_default=True, help="Attendance rows per student.")
+@click.option("--days", type=int, default=90, show_default=True, help="Days of term the rows spread over.")
+@click.option("--budget", type=float, default=2.0, show_default=True, help="Seconds spent timing each benchmark.")
+@click.option("--max-runs", type=int, default=200, show_default=True, help="Upper bound on runs per benchmark.")
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--out", type=click.Path(dir_okay=False), default=None, help="Write JSON results here.")
+@click.option("--keep", is_flag=True, help="Keep the generated scratch directories.")
+def run(scales, checkins, days, budget, max_runs, seed, out, keep):
+    """Generate each scale in a fresh subprocess and time the hot paths"""
+    report = {"meta": environment(), "settings": {"checkins": checkins, "days": days, "budget": budget,
+                                                   "max_runs": max_runs, "seed": seed},
+              "scales": {}}
+    for students in [int(s) for s in scales.split(",") if s.strip()]:
+        workdir = tempfile.mkdtemp(prefix=f"attendance-bench-{students}-")
+        os.makedirs(os.path.join(workdir, "static", "uploads"))
+        result_file = os.path.join(workdir, "result.json")
+        click.echo(f"Scale {students} students in {workdir}", err=True)
+        try:
+            subprocess.run([sys.executable, os.path.abspath(__file__), "scale", str(students), result_file,
+                            "--checkins", str(checkins), "--days", str(days), "--budget", str(budget),
+                            "--max-runs", str(max_runs), "--seed", str(seed)],
+                           cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+            with open(result_file) as f:
+                report["scales"][str(students)] = json.load(f)
+        finally:
+            if not keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if out:
+        with open(out, "w") as f:
+            f.write(text + "\n")
+        click.echo(f"Wrote {out}", err=True)
+    else:
+        click.echo(text)
+
+@cli.command("scale", hidden=True)
+@click.argument("students", type=int)
+@click.argument("result_file", type=click.Path(dir_okay=False))
+@click.option("--checkins", type=int, default=30)
+@click.option("--days", type=int, default=90)
+@click.option("--budget", type=float, default=2.0)
+@click.option("--max-runs", type=int, default=200)
+@click.option("--seed", type=int, default=0)
+def scale_command(students, result_file, checkins, days, budget, max_runs, seed):
+    """Worker for one scale; runs inside its scratch directory"""
+    result = run_scale(students, checkins, days, budget, max_runs, seed)
+    with open(result_file, "w") as f:
+        json.dump(result, f)
+
+@cli.command()
+@click.argument("baseline", type=click.File("r"))
+@click.argument("candidate", type=click.File("r"))
+@click.option("--threshold", type=float, default=0.2, show_default=True,
+              help="Relative p50 slowdown reported as a regression.")
+def compare(baseline, candidate, threshold):
+    """Compare two result files; exits 1 if anything regressed"""
+    old, new = json.load(baseline), json.load(candidate)
+    click.echo(f"baseline {(old['meta'].get('commit') or '?')[:10]}  candidate {(new['meta'].get('commit') or '?')[:10]}")
+    regressions = 0
+    for scale, result in new["scales"].items():
+        before = old["scales"].get(scale, {}).get("benchmarks", {})
+        for name, stats in result["benchmarks"].items():
+            if name not in before:
+                continue
+            ratio = stats["p50_ms"] / before[name]["p50_ms"] if before[name]["p50_ms"] else float("inf")
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            elif ratio < 1 - threshold:
+                flag = "  faster"
+            click.echo(f"{scale:>7} {name:<24} p50 {before[name]['p50_ms']:>10.3f} -> {stats['p50_ms']:>10.3f} ms "
+                       f"({ratio:5.2f}x)  p99 {before[name]['p99_ms']:>10.3f} -> {stats['p99_ms']:>10.3f} ms{flag}")
+    click.echo(f"{regressions} regression(s) beyond {threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+@cli.command()
+@click.option("--runs", type=int, default=10, show_default=True, help="Fresh processes to time.")
+@click.option("--budget-ms", type=float, default=IMPORT_BUDGET_MS, show_default=True,
+              help="Allowed p50 for importing app.py, Flask's own imports excluded.")
+def startup(runs, budget_ms):
+    """Check the import-time budget; exits 1 if it is exceeded"""
+    workdir = tempfile.mkdtemp(prefix="attendance-startup-")
+    try:
+        os.makedirs(os.path.join(workdir, "static", "uploads"))
+        subprocess.run([sys.executable, "-c", "import sys; sys.path.insert(0, sys.argv[1]); import app; app.init_db()",
+                        REPO_DIR], cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+        stats, vision_loaded = measure_startup(runs, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for name, step in stats.items():
+        click.echo(f"{name:<16} p50 {step['p50_ms']:>8.1f} ms  p99 {step['p99_ms']:>8.1f} ms")
+    failures = []
+    if stats["import_app"]["p50_ms"] > budget_ms:
+        failures.append(f"import_app p50 is over the {budget_ms:g} ms budget")
+    if vision_loaded:
+        failures.append(f"importing app.py and serving the dashboard loaded {', '.join(vision_loaded)}")
+    for failure in failures:
+        click.echo(f"FAIL: {failure}")
+    if not failures:
+        click.echo(f"import_app within the {budget_ms:g} ms budget; OpenCV and numpy stay unloaded")
+    sys.exit(1 if failures else 0)
+
+def environment():
+    """What produced a result file, so comparisons are like for like"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__,
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+
+if __name__ == "__main__":
+    cli()
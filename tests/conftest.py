@@ -0,0 +1,27 @@
+"""Shared fixtures: each test gets its own database, created by init_db."""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as attendance_app
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """A fresh database file set up the way `flask init-db` does"""
+    path = str(tmp_path / "attendance.db")
+    monkeypatch.setattr(attendance_app, "DB_NAME", path)
+    attendance_app.init_db()
+    return path
+
+
+@pytest.fixture
+def conn(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    yield conn
+    conn.close()
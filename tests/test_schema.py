@@ -0,0 +1,118 @@
+"""Schema migrations and the trigger-maintained attendance rollups."""
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import app as attendance_app
+from app import SCHEMA_MIGRATIONS, rebuild_attendance_rollups
+
+ROLLUP_TABLES = {
+    "daily_module_attendance": "date, module_code, present_count",
+    "module_attendance_summary": "module_code, session_days",
+    "student_module_attendance": "student_id, module_code, days_present",
+}
+
+
+def schema_objects(conn, kind):
+    return {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = ?", (kind,))}
+
+
+def rollups(conn):
+    return {table: sorted(tuple(r) for r in conn.execute(f"SELECT {columns} FROM {table}"))
+            for table, columns in ROLLUP_TABLES.items()}
+
+
+def test_fresh_database_is_fully_migrated(conn):
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(SCHEMA_MIGRATIONS)
+    assert {"attendance", "face_templates", "modules", "enrolments", "template_store",
+            "job_results", "stream_sessions", "stream_marks", *ROLLUP_TABLES} <= schema_objects(conn, "table")
+    assert {"idx_attendance_student_date_module", "idx_attendance_date", "idx_students_student_id_nocase",
+            "idx_job_results_updated"} <= schema_objects(conn, "index")
+    assert {"attendance_rollups_insert", "attendance_rollups_delete"} <= schema_objects(conn, "trigger")
+
+
+def test_init_db_is_idempotent(db_path, conn):
+    attendance_app.init_db()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(SCHEMA_MIGRATIONS)
+    assert conn.execute("SELECT COUNT(*) FROM lecturers").fetchone()[0] == 1
+
+
+def test_upgrades_the_shipped_database(tmp_path, monkeypatch):
+    shipped = os.path.join(os.path.dirname(attendance_app.__file__), "attendance.db")
+    path = str(tmp_path / "legacy.db")
+    shutil.copyfile(shipped, path)
+    monkeypatch.setattr(attendance_app, "DB_NAME", path)
+
+    attendance_app.init_db()
+
+    conn = sqlite3.connect(path)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(SCHEMA_MIGRATIONS)
+        before = rollups(conn)
+        rebuild_attendance_rollups(conn)
+        assert rollups(conn) == before
+    finally:
+        conn.close()
+
+
+def test_failed_migration_rolls_back(tmp_path, monkeypatch):
+    def broken(conn):
+        """Always fails"""
+        conn.execute("CREATE TABLE half_done (id INTEGER)")
+        raise sqlite3.OperationalError("boom")
+
+    monkeypatch.setattr(attendance_app, "SCHEMA_MIGRATIONS", SCHEMA_MIGRATIONS + [broken])
+    monkeypatch.setattr(attendance_app, "DB_NAME", str(tmp_path / "broken.db"))
+    with pytest.raises(sqlite3.OperationalError):
+        attendance_app.init_db()
+
+    conn = sqlite3.connect(str(tmp_path / "broken.db"))
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(SCHEMA_MIGRATIONS)
+        assert "half_done" not in schema_objects(conn, "table")
+    finally:
+        conn.close()
+
+
+def test_duplicate_check_ins_are_rejected(conn):
+    insert = "INSERT INTO attendance (student_id, date, time, module_code) VALUES ('S001', '2026-03-02', ?, 'ALDS301')"
+    conn.execute(insert, ("09:00:00",))
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute(insert, ("09:05:00",))
+
+
+def test_rollups_follow_inserts_and_deletes(conn):
+    rows = [("S1", "2026-03-02", "ALDS301"), ("S2", "2026-03-02", "ALDS301"),
+            ("S1", "2026-03-03", "ALDS301"), ("S1", "2026-03-02", "SEP401")]
+    conn.executemany("INSERT INTO attendance (student_id, date, time, module_code) VALUES (?, ?, '09:00:00', ?)", rows)
+
+    assert rollups(conn) == {
+        "daily_module_attendance": [("2026-03-02", "ALDS301", 2), ("2026-03-02", "SEP401", 1),
+                                    ("2026-03-03", "ALDS301", 1)],
+        "module_attendance_summary": [("ALDS301", 2), ("SEP401", 1)],
+        "student_module_attendance": [("S1", "ALDS301", 2), ("S1", "SEP401", 1), ("S2", "ALDS301", 1)],
+    }
+
+    # Removing the only check-in of a day drops that session day
+    conn.execute("DELETE FROM attendance WHERE date = '2026-03-03'")
+    conn.execute("DELETE FROM attendance WHERE student_id = 'S2'")
+    assert rollups(conn) == {
+        "daily_module_attendance": [("2026-03-02", "ALDS301", 1), ("2026-03-02", "SEP401", 1)],
+        "module_attendance_summary": [("ALDS301", 1), ("SEP401", 1)],
+        "student_module_attendance": [("S1", "ALDS301", 1), ("S1", "SEP401", 1)],
+    }
+
+
+def test_rollups_match_a_full_rebuild(conn):
+    modules = ["ALDS301", "SEP401", "DBS501"]
+    rows = [(f"S{s}", f"2026-03-{d:02d}", modules[(s + d) % 3])
+            for s in range(12) for d in range(1, 15) if (s * d) % 4]
+    conn.executemany("INSERT INTO attendance (student_id, date, time, module_code) VALUES (?, ?, '10:00:00', ?)", rows)
+    conn.execute("DELETE FROM attendance WHERE id % 5 = 0")
+    conn.execute("DELETE FROM attendance WHERE student_id = 'S3'")
+
+    maintained = rollups(conn)
+    rebuild_attendance_rollups(conn)
+    assert rollups(conn) == maintained
@@ -0,0 +1,68 @@
+"""FTPL face template BLOBs: encode/decode round trip and legacy upgrades."""
+import pickle
+
+import numpy as np
+import pytest
+
+from app import (TEMPLATE_HEADER, TEMPLATE_MAGIC, TEMPLATE_VERSION, decode_template,
+                 encode_template, is_template, migrate_face_templates)
+
+
+def vector(dim=128, seed=0):
+    return np.random.default_rng(seed).standard_normal(dim) * 7
+
+
+@pytest.mark.parametrize("dtype, itemsize, tolerance", [("float32", 4, 1e-6), ("float16", 2, 1e-3)])
+def test_round_trip_is_normalised(dtype, itemsize, tolerance):
+    features = vector()
+    blob = encode_template(features, dtype)
+
+    assert is_template(blob)
+    assert len(blob) == TEMPLATE_HEADER.size + features.size * itemsize
+    magic, version, _, _, dim = TEMPLATE_HEADER.unpack_from(blob)
+    assert (magic, version, dim) == (TEMPLATE_MAGIC, TEMPLATE_VERSION, features.size)
+
+    decoded = decode_template(blob)
+    np.testing.assert_allclose(decoded, features / np.linalg.norm(features), atol=tolerance)
+
+
+def test_decode_is_a_read_only_view():
+    decoded = decode_template(encode_template(vector(), "float32"))
+    assert not decoded.flags.writeable
+
+
+def test_zero_vector_stays_zero():
+    decoded = decode_template(encode_template(np.zeros(16), "float32"))
+    assert decoded.shape == (16,) and not decoded.any()
+
+
+def test_decode_rejects_malformed_blobs():
+    blob = encode_template(vector(), "float32")
+    header = bytearray(blob)
+    header[4] = TEMPLATE_VERSION + 1
+    unknown_dtype = bytearray(blob)
+    unknown_dtype[5] = 99
+
+    assert decode_template(None) is None
+    assert decode_template(pickle.dumps(vector())) is None
+    assert decode_template(blob[:-1]) is None
+    assert decode_template(blob[:8]) is None
+    assert decode_template(bytes(header)) is None
+    assert decode_template(bytes(unknown_dtype)) is None
+
+
+def test_migrate_upgrades_pickled_and_reprecises_templates(conn):
+    legacy = vector(seed=1)
+    conn.execute("INSERT INTO students (student_id, name, mobile, password, face_encoding) VALUES (?, ?, ?, ?, ?)",
+                 ("P1", "Pickled", "0", "pw", pickle.dumps(legacy)))
+    conn.execute("INSERT INTO students (student_id, name, mobile, password, face_encoding) VALUES (?, ?, ?, ?, ?)",
+                 ("H1", "Half", "0", "pw", encode_template(vector(seed=2), "float16")))
+    conn.commit()
+
+    assert migrate_face_templates(conn, "float32") == 2
+    rows = dict(conn.execute("SELECT student_id, face_encoding FROM students WHERE face_encoding IS NOT NULL"))
+    np.testing.assert_allclose(decode_template(rows["P1"]), legacy / np.linalg.norm(legacy), atol=1e-6)
+    assert decode_template(rows["H1"]).dtype == np.float32
+
+    # Already in the target format: nothing left to rewrite
+    assert migrate_face_templates(conn, "float32") == 0